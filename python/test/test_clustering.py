@@ -1,7 +1,12 @@
+import os
 import shutil
 import tempfile
-from numpy import array, array_equal
-from thunder.clustering.kmeans import kmeans
+from numpy import array, array_equal, allclose, random, sum
+from thunder.clustering.kmeans import kmeans, kmeanssweep, closestpoint, closestcenters
+from thunder.clustering.bisectingkmeans import bisectingkmeans
+from thunder.clustering.streamingkmeans import StreamingKMeans, StreamingKMeansModel, streamingkmeans
+from thunder.util.checkpoint import Checkpoint
+from thunder.util.save import save
 from test_utils import PySparkTestCase
 
 
@@ -30,5 +35,174 @@ class TestKMeans(ClusteringTestCase):
         assert array_equal(centers[0], array([1.0, 3.0, 4.0]))
         assert array_equal(labels.map(lambda (_, v): v).collect(), array([0, 0, 0]))
 
+    def test_kmeans_checkpoint(self):
+        """Resuming from a saved state gives the same result as an uninterrupted run"""
 
+        data_local = [
+            array([1.0, 1.0]),
+            array([1.5, 2.0]),
+            array([3.0, 4.0]),
+            array([5.0, 7.0]),
+            array([3.5, 5.0]),
+            array([4.5, 5.0]),
+            array([3.5, 4.5])]
+
+        data = self.sc.parallelize(zip(range(1, 8), data_local))
+
+        labels_true, centers_true = kmeans(data, k=2, maxiter=20, tol=0.001)
+
+        checkpoint = Checkpoint(self.outputdir, interval=1)
+        kmeans(data, k=2, maxiter=1, tol=0.001, checkpoint=checkpoint)
+        assert os.path.exists(os.path.join(self.outputdir, "kmeans.pickle"))
+
+        checkpoint = Checkpoint(self.outputdir, interval=1, resume=True)
+        assert checkpoint.restore("kmeans")["iter"] == 1
+        labels, centers = kmeans(data, k=2, maxiter=20, tol=0.001, checkpoint=checkpoint)
+        assert allclose(centers, centers_true)
+        assert array_equal(labels.map(lambda (_, v): v).collect(), labels_true.map(lambda (_, v): v).collect())
+
+    def test_kmeans_warmstart(self):
+        """Starting from the saved centers of a previous run converges immediately"""
+
+        data_local = [
+            array([1.0, 1.0]),
+            array([1.5, 2.0]),
+            array([3.0, 4.0]),
+            array([5.0, 7.0]),
+            array([3.5, 5.0]),
+            array([4.5, 5.0]),
+            array([3.5, 4.5])]
+
+        data = self.sc.parallelize(zip(range(1, 8), data_local))
+
+        labels_true, centers_true = kmeans(data, k=2, maxiter=20, tol=0.001)
+        save(centers_true, self.outputdir, "centers", "matlab")
+
+        labels, centers = kmeans(data, k=2, maxiter=1, tol=0.001, warmstart=self.outputdir)
+        assert allclose(centers, centers_true)
+        assert array_equal(labels.map(lambda (_, v): v).collect(), labels_true.map(lambda (_, v): v).collect())
+
+    def test_kmeans_parallel_init(self):
+        """Initializing with k-means|| finds well separated clusters"""
+
+        random.seed(42)
+        offsets = array([[0.0, 0.0], [10.0, 10.0], [-10.0, 10.0]])
+        data_local = [offsets[i % 3] + random.randn(2) * 0.1 for i in range(0, 60)]
+
+        data = self.sc.parallelize(zip(range(0, 60), data_local), 4)
+
+        labels, centers = kmeans(data, k=3, maxiter=20, tol=0.001, init="k-means||", seed=1)
+        labels = array(labels.map(lambda (_, v): v).collect())
+        assert len(set(labels[0:3])) == 3
+        assert array_equal(labels, array([labels[i % 3] for i in range(0, 60)]))
+        assert allclose(sorted(map(tuple, centers)), sorted(map(tuple, offsets)), atol=0.1)
+
+    def test_kmeans_minibatch(self):
+        """Mini-batch iterations on a sample of each block find well separated clusters"""
+
+        random.seed(42)
+        offsets = array([[0.0, 0.0], [10.0, 10.0], [-10.0, 10.0]])
+        data_local = [offsets[i % 3] + random.randn(2) * 0.1 for i in range(0, 300)]
+
+        data = self.sc.parallelize(zip(range(0, 300), data_local), 4)
+
+        labels, centers = kmeans(data, k=3, maxiter=10, tol=0, init="k-means||", seed=1, minibatch=0.2)
+        labels = array(labels.map(lambda (_, v): v).collect())
+        assert array_equal(labels, array([labels[i % 3] for i in range(0, 300)]))
+        assert allclose(sorted(map(tuple, centers)), sorted(map(tuple, offsets)), atol=0.1)
+
+    def test_kmeans_accelerate(self):
+        """Skipping distance computations with bounds gives the same result as full iterations"""
+
+        random.seed(42)
+        data_local = list(random.randn(200, 3))
+
+        data = self.sc.parallelize(zip(range(0, 200), data_local), 4)
+
+        labels_true, centers_true = kmeans(data, k=5, maxiter=20, tol=0.00001)
+        labels, centers = kmeans(data, k=5, maxiter=20, tol=0.00001, accelerate=True)
+        assert allclose(centers, centers_true)
+        assert array_equal(labels.map(lambda (_, v): v).collect(), labels_true.map(lambda (_, v): v).collect())
+
+        checkpoint = Checkpoint(self.outputdir, interval=2)
+        labels, centers = kmeans(data, k=5, maxiter=20, tol=0.00001, accelerate=True, checkpoint=checkpoint)
+        assert allclose(centers, centers_true)
+
+    def test_kmeans_sweep(self):
+        """Each configuration of a sweep matches a separate run from the same initial centers"""
+
+        random.seed(42)
+        offsets = array([[0.0, 0.0], [10.0, 10.0], [-10.0, 10.0]])
+        data_local = [offsets[i % 3] + random.randn(2) for i in range(0, 60)]
+
+        data = self.sc.parallelize(zip(range(0, 60), data_local), 4)
+
+        labels, centers, costs, configs = kmeanssweep(data, [1, 2, 3], nrestarts=2, maxiter=20, tol=0.00001, seed=1)
+        assert configs == [(1, 0), (1, 1), (2, 0), (2, 1), (3, 0), (3, 1)]
+        assert allclose(centers[0], centers[1])
+        assert allclose(costs[0], sum((array(data_local) - centers[0]) ** 2))
+        assert all(costs[4:6] < costs[0])
+        labels = array(labels.map(lambda (_, v): v).collect())
+        for (i, (k, r)) in enumerate(configs):
+            labels_true, centers_true = kmeans(data, k, maxiter=20, tol=0.00001, warmstart=centers[i])
+            assert allclose(centers[i], centers_true)
+            assert array_equal(labels[:, i], labels_true.map(lambda (_, v): v).collect())
+
+    def test_bisecting_kmeans(self):
+        """Bisecting kmeans splits well separated clusters, with tree and labels consistent"""
+
+        random.seed(42)
+        offsets = array([[0.0, 0.0], [0.0, 10.0], [30.0, 0.0], [30.0, 10.0]])
+        data_local = [offsets[i % 4] + random.randn(2) * 0.1 for i in range(0, 80)]
+
+        data = self.sc.parallelize(zip(range(0, 80), data_local), 4)
+
+        labels, centers, tree = bisectingkmeans(data, k=4, seed=1)
+        labels = array(labels.map(lambda (_, v): v).collect())
+        centers = centers[array([labels[i] for i in range(0, 4)])]
+        assert len(tree) == 7
+        assert tree[0]["count"] == 80
+        assert allclose(tree[0]["center"], sum(array(data_local), axis=0) / 80)
+        assert all([tree[c]["count"] == 20 for c in range(3, 7)])
+        assert len(set(labels[0:4])) == 4
+        assert array_equal(labels, array([labels[i % 4] for i in range(0, 80)]))
+        assert allclose(centers, offsets, atol=0.1)
+
+    def test_closest_centers(self):
+        """Block assignment matches assigning points one at a time"""
+
+        random.seed(42)
+        x = random.randn(50, 4)
+        centers = random.randn(5, 4)
+        labels = closestcenters(x, sum(x ** 2, axis=1), centers, sum(centers ** 2, axis=1))
+        assert array_equal(labels, [closestpoint(p, centers) for p in x])
+
+
+class TestStreamingKMeans(ClusteringTestCase):
+    def test_streaming_kmeans(self):
+        """Mini batch updates give the running mean of all points in each cluster,
+        and resuming from a saved model continues where it left off"""
+
+        batch1 = self.sc.parallelize(zip(range(1, 4), [array([1.0, 1.0]), array([2.0, 2.0]), array([9.0, 9.0])]))
+        batch2 = self.sc.parallelize(zip(range(4, 6), [array([3.0, 3.0]), array([11.0, 11.0])]))
+
+        model = StreamingKMeansModel(array([[0.0, 0.0], [10.0, 10.0]]), array([0.0, 0.0]))
+        algorithm = StreamingKMeans(k=2, d=2, a=1.0)
+        model = algorithm.update(batch1, model)
+        assert allclose(model.centers, [[1.5, 1.5], [9.0, 9.0]])
+        assert allclose(model.counts, [2, 1])
+        model = algorithm.update(batch2, model)
+        assert allclose(model.centers, [[2.0, 2.0], [10.0, 10.0]])
+        assert array_equal(model.predict(batch2).map(lambda (_, v): v).collect(), [0, 1])
+
+        model = StreamingKMeansModel(array([[0.0, 0.0], [10.0, 10.0]]), array([0.0, 0.0]))
+        model = StreamingKMeans(k=2, d=2, a=0.5).update(batch1, model)
+        assert allclose(model.centers, [[0.75, 0.75], [9.5, 9.5]])
 
+        checkpoint = Checkpoint(self.outputdir, interval=1)
+        labels, model_true = streamingkmeans([batch1, batch2], k=2, d=2, seed=1)
+        streamingkmeans([batch1], k=2, d=2, seed=1, checkpoint=checkpoint)
+        checkpoint = Checkpoint(self.outputdir, interval=1, resume=True)
+        labels, model = streamingkmeans([batch2], k=2, d=2, checkpoint=checkpoint)
+        assert allclose(model.centers, model_true.centers)
+        assert allclose(model.counts, model_true.counts)
@@ -1,11 +1,13 @@
 import os
 import shutil
 import tempfile
-from numpy import array, allclose, transpose
+from numpy import array, allclose, transpose, argmax, abs, dot, sign, corrcoef, all, isfinite, random
+from numpy.linalg import norm
 import scipy.linalg as LinAlg
 from scipy.io import loadmat
 from thunder.factorization.ica import ica
-from thunder.factorization.util import svd
+from thunder.factorization.util import svd, IncrementalSVD
+from thunder.factorization.incrementalpca import incrementalpca
 from thunder.util.load import load
 from test_utils import PySparkTestCase
 
@@ -49,6 +51,35 @@ class TestSVD(FactorizationTestCase):
         assert(allclose(v_test, v_true[0, :]) | allclose(-v_test, v_true[0, :]))
         assert(allclose(u_test, u_true[:, 0]) | allclose(-u_test, u_true[:, 0]))
 
+    def test_svd_direct_gram(self):
+        data_local = [
+            array([1.0, 2.0, 6.0, 1.0, 3.0, 2.0, 4.0]),
+            array([1.0, 3.0, 0.0, 5.0, 2.0, 1.0, 0.0]),
+            array([1.0, 4.0, 6.0, 2.0, 1.0, 3.0, 5.0])
+        ]
+        data = self.sc.parallelize(zip(range(1, 4), data_local))
+
+        u, s, v = svd(data, 1, meansubtract=0, method="direct")
+        u_true, s_true, v_true = LinAlg.svd(array(data_local))
+        u_test = transpose(array(u.map(lambda (_, v): v).collect()))[0]
+        v_test = v[0]
+        assert(allclose(s[0], s_true[0]))
+        assert(allclose(v_test, v_true[0, :]) | allclose(-v_test, v_true[0, :]))
+        assert(allclose(u_test, u_true[:, 0]) | allclose(-u_test, u_true[:, 0]))
+
+    def test_svd_direct_gram_rank_deficient(self):
+        random.seed(42)
+        data_local = random.randn(5, 12)
+        data_local[4] = data_local[3]
+        data = self.sc.parallelize(zip(range(0, 5), data_local))
+
+        u, s, v = svd(data, 5, meansubtract=0, method="direct")
+        s_true = LinAlg.svd(data_local)[1]
+        assert(all(isfinite(s)) & all(isfinite(v)))
+        assert(allclose(s[0:4], s_true[0:4]))
+        assert(s[4] == 0)
+        assert(all(v[4] == 0))
+
     def test_svd_em(self):
         data_local = [
             array([1.0, 2.0, 6.0]),
@@ -67,12 +98,63 @@ class TestSVD(FactorizationTestCase):
         assert(allclose(v_test, v_true[0, :], atol=tol) | allclose(-v_test, v_true[0, :], atol=tol))
         assert(allclose(u_test, u_true[:, 0], atol=tol) | allclose(-u_test, u_true[:, 0], atol=tol))
 
+    def test_svd_em_history(self):
+        data_local = [
+            array([1.0, 2.0, 6.0]),
+            array([1.0, 3.0, 0.0]),
+            array([1.0, 4.0, 6.0]),
+            array([5.0, 1.0, 4.0])
+        ]
+        data = self.sc.parallelize(zip(range(1, 5), data_local))
+
+        u, s, v, errvec = svd(data, 1, meansubtract=0, method="em", maxiter=20, tol=0.00001, history=True)
+        s_true = LinAlg.svd(array(data_local))[1]
+        tol = 10e-04  # allow small error for iterative method
+        assert(allclose(s[0], s_true[0], atol=tol))
+        assert(0 < len(errvec) <= 20)
+        assert((errvec[-1] <= 0.00001) | (len(errvec) == 20))
+
+
+class TestIncrementalSVD(FactorizationTestCase):
+    """Test that updating with two batches of records
+    matches the decomposition of all records at once
+    (exact when k equals the number of dimensions)
+    """
+    def test_incremental_svd(self):
+        data_local = [
+            array([1.0, 2.0, 6.0]),
+            array([1.0, 3.0, 0.0]),
+            array([1.0, 4.0, 6.0]),
+            array([5.0, 1.0, 4.0]),
+            array([2.0, 1.0, 3.0])
+        ]
+        batch1 = self.sc.parallelize(zip(range(1, 3), data_local[0:2]))
+        batch2 = self.sc.parallelize(zip(range(3, 6), data_local[2:5]))
+
+        model = IncrementalSVD(3)
+        model.update(batch1)
+        u, s, v = model.update(batch2)
+        u_true, s_true, v_true = LinAlg.svd(array(data_local))
+        u_test = transpose(array(u.map(lambda (_, v): v).collect()))[0]
+        v_test = v[0]
+        assert(model.n == 5)
+        assert(allclose(s, s_true))
+        assert(allclose(v_test, v_true[0, :]) | allclose(-v_test, v_true[0, :]))
+        assert(allclose(u_test, u_true[2:5, 0]) | allclose(-u_test, u_true[2:5, 0]))
+
+        u, s, v = incrementalpca([batch1, batch2], 3)
+        assert(allclose(s, s_true))
+
 
 class TestICA(FactorizationTestCase):
     """Test that ICA returns correct
     results by comparing to known, vetted
     results for the example data set
     and a fixed random seed
+
+    Components are only determined up to
+    sign and order, so each vetted component
+    is compared to its best matching estimate
     """
     def test_ica(self):
         ica_data = os.path.join(DATA_DIR, "ica.txt")
@@ -81,7 +163,40 @@ class TestICA(FactorizationTestCase):
         w, sigs = ica(data, 4, 4, svdmethod="direct", seed=1)
         w_true = loadmat(os.path.join(ica_results, "w.mat"))["w"]
         sigs_true = loadmat(os.path.join(ica_results, "sigs.mat"))["sigs"]
+        sigs = transpose(sigs.map(lambda (_, v): v).collect())
         tol = 10e-02
-        assert(allclose(w, w_true, atol=tol))
-        assert(allclose(transpose(sigs.map(lambda (_, v): v).collect()), sigs_true, atol=tol))
+        for i in range(0, 4):
+            j = argmax([abs(dot(x, w_true[i])) / norm(x) for x in w])
+            s = sign(dot(w[j], w_true[i]))
+            assert(allclose(s * w[j], w_true[i], atol=tol))
+            assert(allclose(s * sigs[j], sigs_true[i], atol=tol))
+
+    def test_ica_nonlinearities(self):
+        ica_data = os.path.join(DATA_DIR, "ica.txt")
+        ica_results = os.path.join(DATA_DIR, "results/ica")
+        data = load(self.sc, ica_data, "raw")
+        sigs_true = loadmat(os.path.join(ica_results, "sigs.mat"))["sigs"]
+        for nonlinearity in ["logcosh", "gauss"]:
+            w, sigs = ica(data, 4, 4, svdmethod="direct", seed=1, nonlinearity=nonlinearity)
+            sigs = transpose(sigs.map(lambda (_, v): v).collect())
+            corr = abs(corrcoef(sigs, sigs_true)[4:, 0:4])
+            assert(all(corr.max(axis=1) > 0.99))
+
+    def test_ica_restarts(self):
+        ica_data = os.path.join(DATA_DIR, "ica.txt")
+        ica_results = os.path.join(DATA_DIR, "results/ica")
+        data = load(self.sc, ica_data, "raw")
+        sigs_true = loadmat(os.path.join(ica_results, "sigs.mat"))["sigs"]
+        w, sigs = ica(data, 4, 4, svdmethod="direct", seed=1, nrestarts=3)
+        sigs = transpose(sigs.map(lambda (_, v): v).collect())
+        corr = abs(corrcoef(sigs, sigs_true)[4:, 0:4])
+        assert(all(corr.max(axis=1) > 0.99))
 
+    def test_ica_warmstart(self):
+        ica_data = os.path.join(DATA_DIR, "ica.txt")
+        ica_results = os.path.join(DATA_DIR, "results/ica")
+        data = load(self.sc, ica_data, "raw")
+        w_true = loadmat(os.path.join(ica_results, "w.mat"))["w"]
+        w, sigs = ica(data, 4, 4, svdmethod="direct", maxiter=2, warmstart=ica_results)
+        tol = 10e-02
+        assert(allclose(w, w_true, atol=tol))
@@ -1,13 +1,51 @@
+import os
 import shutil
 import tempfile
-from numpy import array, allclose, pi
+from numpy import array, allclose, pi, random, outer, inner, mean, dot, transpose, eye, concatenate, \
+    linspace, exp, cos, angle, abs
+from numpy.linalg import inv
 from thunder.regression.util import RegressionModel, TuningModel
+from thunder.util.permutation import permutations
 from thunder.regression.regress import regress
 from thunder.regression.regresswithpca import regresswithpca
 from thunder.regression.tuning import tuning
+from thunder.regression.streamingregression import StatefulLinearRegression, streamingregression
+from thunder.util.checkpoint import Checkpoint
 from test_utils import PySparkTestCase
 
 
+def circulartuning(s, y):
+    """Reference per record circular mean and kappa"""
+    y = y - y.min()
+    if y.sum() == 0:
+        y = y + 1E-06
+    y = y / y.sum()
+    r = inner(y, exp(1j * s))
+    v = abs(r) / y.sum()
+    if v < 0.53:
+        k = 2 * v + (v ** 3) + 5 * (v ** 5) / 6
+    elif v < 0.85:
+        k = -.4 + 1.39 * v + 0.43 / (1 - v)
+    elif (v ** 3 - 4 * (v ** 2) + 3 * v) == 0:
+        k = 0.0
+    else:
+        k = 1 / (v ** 3 - 4 * (v ** 2) + 3 * v)
+    if k > 1E8:
+        k = 0.0
+    return array([angle(r), k])
+
+
+def gaussiantuning(s, y):
+    """Reference per record gaussian mean and variance"""
+    y = y.copy()
+    y[y < 0] = 0
+    if y.sum() == 0:
+        y = y + 1E-06
+    y = y / y.sum()
+    mu = dot(s, y)
+    return array([mu, dot((s - mu) ** 2, y)])
+
+
 class RegressionTestCase(PySparkTestCase):
     def setUp(self):
         super(RegressionTestCase, self).setUp()
@@ -46,6 +84,123 @@ class TestRegress(RegressionTestCase):
         stats.collect()
         scores.collect()
 
+    def test_regress_block(self):
+        random.seed(42)
+        data_local = random.randn(10, 6)
+        data = self.sc.parallelize(zip(range(0, 10), data_local), 3)
+        linear = RegressionModel.load(random.randn(2, 6), "linear")
+        bilinear = RegressionModel.load((random.randn(2, 6), random.randn(3, 6)), "bilinear")
+        for model in [linear, bilinear]:
+            betas, stats, resid = model.fit(data)
+            for (y, b, r2, r) in zip(data_local, betas.map(lambda (_, v): v).collect(),
+                                     stats.map(lambda (_, v): v).collect(), resid.map(lambda (_, v): v).collect()):
+                b_true, r2_true, r_true = model.get(y)
+                assert(allclose(b, b_true))
+                assert(allclose(r2, r2_true))
+                assert(allclose(r, r_true))
+
+    def test_ridge_regress(self):
+        random.seed(42)
+        data_local = random.randn(10, 8)
+        data = self.sc.parallelize(zip(range(0, 10), data_local), 3)
+        x = random.randn(2, 8)
+        model = RegressionModel.load(x, "ridge", [0.0, 2.0])
+        betas, stats, resid = model.fit(data)
+        betas = array(betas.map(lambda (_, v): v).collect())
+        stats = array(stats.map(lambda (_, v): v).collect())
+        resid = array(resid.map(lambda (_, v): v).collect())
+        linear = RegressionModel.load(x, "linear")
+        xc = x - mean(x, axis=1)[:, None]
+        for (i, y) in enumerate(data_local):
+            b_true, r2_true, r_true = linear.get(y)
+            assert(allclose(betas[i, 0:2], b_true))
+            assert(allclose(stats[i, 0], r2_true))
+            assert(allclose(resid[i, 0:8], r_true))
+            b_ridge = dot(inv(dot(xc, transpose(xc)) + 2.0 * eye(2)), dot(xc, y - mean(y)))
+            assert(allclose(betas[i, 2:4], b_ridge))
+            r_ridge = y - mean(y) - dot(b_ridge, xc)
+            assert(allclose(resid[i, 8:16], r_ridge))
+            assert(allclose(stats[i, 1], 1 - sum(r_ridge ** 2) / sum((y - mean(y)) ** 2)))
+
+        model = RegressionModel.load(x, "ridge", [0.0, 2.0], True)
+        betas, stats, resid = model.fit(data)
+        betas = array(betas.map(lambda (_, v): v).collect())
+        stats = array(stats.map(lambda (_, v): v).collect())
+        assert(betas.shape == (10, 2))
+        assert(all([l in [0.0, 2.0] for l in stats[:, 1]]))
+
+        stats, betas = regress(data, x, "ridge", [0.0, 2.0])
+        stats.collect()
+        betas.collect()
+
+    def test_multi_regress(self):
+        random.seed(42)
+        x1 = random.randn(2, 12)
+        x2 = random.randn(3, 12)
+        data_local = random.randn(6, 12)
+        data_local[0] += 3 * x2[1]
+        data = self.sc.parallelize(zip(range(0, 6), data_local), 2)
+        model = RegressionModel.load({"a": x1, "b": x2}, "multi")
+        betas, stats, resid = model.fit(data)
+        betas = array(betas.map(lambda (_, v): v).collect())
+        stats = array(stats.map(lambda (_, v): v).collect())
+        resid = array(resid.map(lambda (_, v): v).collect())
+        for (i, y) in enumerate(data_local):
+            b1, r1, e1 = RegressionModel.load(x1, "linear").get(y)
+            b2, r2, e2 = RegressionModel.load(x2, "linear").get(y)
+            assert(allclose(betas[i], concatenate((b1, b2))))
+            assert(allclose(stats[i], [r1, r2]))
+            assert(allclose(resid[i], concatenate((e1, e2))))
+        best = model.compare(model.fit(data).stats).map(lambda (_, v): v).collect()
+        assert(best[0] == 1)
+
+    def test_permtest(self):
+        random.seed(42)
+        x = random.randn(2, 20)
+        data_local = random.randn(5, 20)
+        data_local[0] += 3 * x[0]
+        data = self.sc.parallelize(zip(range(0, 5), data_local), 2)
+        model = RegressionModel.load(x, "linear")
+        pvals, nulls = model.permtest(data, nperm=50, seed=1, null=True)
+        pvals = array(pvals.map(lambda (_, v): v).collect())
+        nulls = array(nulls.map(lambda (_, v): v).collect())
+        assert(pvals[0] == 1.0 / 51)
+        assert(allclose(model.permtest(data, nperm=50, seed=1).map(lambda (_, v): v).collect(), pvals))
+        assert(allclose(model.permtest(data, nperm=50, seed=1, chunksize=2).map(lambda (_, v): v).collect(), pvals))
+        assert(all((pvals > 0) & (pvals <= 1)))
+        perms = permutations(20, 50, 1)
+        for p in [0, 10]:
+            permuted = RegressionModel.load(x[:, perms[p]], "linear")
+            for (i, y) in enumerate(data_local):
+                assert(allclose(nulls[i, p], permuted.get(y)[1]))
+
+    def test_fit_result(self):
+        random.seed(42)
+        data = self.sc.parallelize(zip(range(0, 10), random.randn(10, 6)), 3)
+        x = random.randn(2, 6)
+        model = RegressionModel.load(x, "linear")
+        result = model.fit(data)
+        result_resid = model.fit(data, resid=True)
+        assert(allclose(result.betas.map(lambda (_, v): v).collect(), result_resid.betas.map(lambda (_, v): v).collect()))
+        assert(allclose(result.stats.map(lambda (_, v): v).collect(), result_resid.stats.map(lambda (_, v): v).collect()))
+        assert(allclose(result.resid.map(lambda (_, v): v).collect(), result_resid.resid.map(lambda (_, v): v).collect()))
+        assert(result.result.flatMap(lambda x: x[3]).collect() == [None] * 10)
+        result.unpersist()
+        result_resid.unpersist()
+        assert(allclose(model.fit(data, storagelevel=None).betas.map(lambda (_, v): v).collect(),
+                        result.betas.map(lambda (_, v): v).collect()))
+
+    def test_trajectories(self):
+        random.seed(42)
+        data_local = random.randn(10, 6)
+        data = self.sc.parallelize(zip(range(0, 10), data_local), 3)
+        x = random.randn(3, 6)
+        comps = random.randn(2, 3)
+        for model in [RegressionModel.load(x, "linear"), RegressionModel.load((x, random.randn(3, 6)), "bilinear")]:
+            traj_true = sum([outer(y, inner(model.get(y)[0] - mean(model.get(y)[0]), comps)) for y in data_local]) / 10
+            assert(allclose(model.fit(data, traj=True).trajectories(comps), traj_true))
+            assert(allclose(model.fit(data, comps), traj_true))
+
     def test_blinear_regress(self):
         data = self.sc.parallelize([(1, array([1.5, 2.3, 6.2, 5.1, 3.4, 2.1]))])
         x1 = array([
@@ -73,6 +228,38 @@ class TestRegress(RegressionTestCase):
         scores.collect()
 
 
+class TestStreamingRegression(RegressionTestCase):
+    """Test that running fits over batches match fitting
+    all the data at once, including after resuming from a checkpoint
+    """
+    def test_streaming_regression(self):
+        random.seed(42)
+        x = random.randn(2, 15)
+        data_local = random.randn(4, 15)
+        batches = [self.sc.parallelize(zip([(0, 0), (0, 1)] + range(0, 4), concatenate((x[:, i:j], data_local[:, i:j]))))
+                   for (i, j) in [(0, 6), (6, 15)]]
+
+        model = RegressionModel.load(x, "linear")
+        model_stream = StatefulLinearRegression([(0, 0), (0, 1)])
+        model_stream.update(batches[0])
+        betas, stats = model_stream.update(batches[1])
+        betas = array(betas.map(lambda (_, v): v).collect())
+        stats = array(stats.map(lambda (_, v): v).collect())
+        for (i, y) in enumerate(data_local):
+            b_true, r2_true, r_true = model.get(y)
+            assert(allclose(betas[i], b_true))
+            assert(allclose(stats[i], r2_true))
+
+        checkpoint = Checkpoint(self.outputdir, interval=1)
+        streamingregression(batches[0:1], [(0, 0), (0, 1)], checkpoint)
+        checkpoint = Checkpoint(self.outputdir, interval=1, resume=True)
+        betas, stats = streamingregression(batches[1:2], [(0, 0), (0, 1)], checkpoint)
+        assert(allclose(sorted(stats.map(lambda (_, v): v).collect()),
+                        sorted([model.get(y)[1] for y in data_local])))
+        assert(sorted(f for f in os.listdir(self.outputdir) if f.startswith("streamingregression-state")) ==
+               ["streamingregression-state-2"])
+
+
 class TestTuning(RegressionTestCase):
     """Test accuracy of gaussian and circular tuning
     by building small stimulus arrays and testing
@@ -102,6 +289,48 @@ class TestTuning(RegressionTestCase):
         tol = 1E-4  # to handle rounding errors
         assert(allclose(params.map(lambda (_, v): v).collect()[0], array([0.10692, 1.61944]), atol=tol))
 
+    def test_tuning_block(self):
+        # rows with circular v below 0.53, between 0.53 and 0.85, above 0.85,
+        # exactly 1 (where kappa is set to 0), all zero and with negative values
+        data_local = array([
+            array([1.5, 2.3, 6.2, 5.1, 3.4, 2.1]),
+            array([0.0, 1.0, 2.0, 4.0, 2.0, 1.0]),
+            array([0.0, 0.0, 1.0, 3.0, 1.0, 0.0]),
+            array([0.0, 0.0, 0.0, 5.0, 1.0, 0.0]),
+            array([0.0, 0.0, 0.0, 0.0, 1.0, 0.0]),
+            array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0]),
+            array([-1.0, 0.0, 0.0, 0.0, 0.0, 0.0]),
+            array([1.5, -2.3, 6.2, 5.1, 3.4, 2.1])
+        ])
+        data = self.sc.parallelize(zip(range(0, 8), data_local), 3)
+        for (s, mode, reference) in [(array([0.1, 0.2, 0.3, 0.4, 0.5, 0.6]), "gaussian", gaussiantuning),
+                                     (array([-pi/2, -pi/3, -pi/4, pi/4, pi/3, pi/2]), "circular", circulartuning)]:
+            model = TuningModel.load(s, mode)
+            params = array(model.fit(data).map(lambda (_, v): v).collect())
+            assert(allclose(params, [reference(s, y) for y in data_local]))
+        y = array([1.5, -2.3, 6.2, 5.1, 3.4, 2.1])
+        TuningModel.load(array([0.1, 0.2, 0.3, 0.4, 0.5, 0.6]), "gaussian").get(y)
+        assert(y[1] == -2.3)
+
+    def test_tuning_least_squares(self):
+        # noiseless von mises and gaussian curves on a baseline should be recovered exactly
+        random.seed(42)
+        n = 20
+        a, b = random.rand(n), 1 + random.rand(n)
+        s = linspace(-pi, pi, 16, endpoint=False)
+        truth = array([random.uniform(-3, 3, n), random.uniform(0.5, 4, n), a, b]).T
+        data_local = array([p[2] + p[3] * exp(p[1] * (cos(s - p[0]) - 1)) for p in truth])
+        data = self.sc.parallelize(zip(range(0, n), data_local), 3)
+        params = array(TuningModel.load(s, "circular-ls").fit(data).map(lambda (_, v): v).collect())
+        assert(allclose(params, truth, atol=1e-06))
+
+        s = linspace(0, 1, 16)
+        truth = array([random.uniform(0.3, 0.7, n), random.uniform(0.005, 0.03, n), a, b]).T
+        data_local = array([p[2] + p[3] * exp(-(s - p[0]) ** 2 / (2 * p[1])) for p in truth])
+        data = self.sc.parallelize(zip(range(0, n), data_local), 3)
+        params = array(TuningModel.load(s, "gaussian-ls").fit(data).map(lambda (_, v): v).collect())
+        assert(allclose(params, truth, atol=1e-06))
+
     def test_tuning_scripts(self):
         data = self.sc.parallelize([(1, array([1.5, 2.3, 6.2, 5.1, 3.4, 2.1]))])
         x1 = array([
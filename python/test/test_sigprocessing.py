@@ -1,7 +1,7 @@
 import os
 import shutil
 import tempfile
-from numpy import array, allclose, mean, median, std, corrcoef
+from numpy import array, allclose, mean, median, std, corrcoef, abs
 from scipy.linalg import norm
 from thunder.sigprocessing.util import SigProcessingMethod
 from thunder.sigprocessing.stats import stats
@@ -9,6 +9,7 @@ from thunder.sigprocessing.fourier import fourier
 from thunder.sigprocessing.crosscorr import crosscorr
 from thunder.sigprocessing.localcorr import localcorr
 from thunder.sigprocessing.query import query
+from thunder.util.permutation import permutations
 from test_utils import PySparkTestCase
 
 
@@ -199,6 +200,33 @@ class TestCrossCorr(SigProcessingTestCase):
         assert(allclose(betas.collect()[0], corrcoef(data_local[0, :], sig)[0, 1]))
         assert(allclose(betas.collect()[1], corrcoef(data_local[1, :], sig)[0, 1]))
 
+    def test_crosscorr_permtest(self):
+        data_local = array([
+            array([1.0, 2.0, -4.0, 5.0, 8.0, 3.0, 4.1, 0.9, 2.3]),
+            array([2.0, 2.0, -4.0, 5.0, 3.1, 4.5, 8.2, 8.1, 9.1]),
+        ])
+
+        sig = array([1.5, 2.1, -4.2, 5.6, 8.1, 3.9, 4.2, 0.3, 2.1])
+
+        data = self.sc.parallelize(zip(range(1, 3), data_local))
+
+        method = SigProcessingMethod.load("crosscorr", sigfile=sig, lag=0)
+        pvals, nulls = method.permtest(data, nperm=20, seed=1, null=True)
+        pvals = array(pvals.map(lambda (_, v): v).collect())
+        nulls = array(nulls.map(lambda (_, v): v).collect())
+        assert(pvals[0] == 1.0 / 21)
+        pvals_chunked, nulls_chunked = method.permtest(data, nperm=20, seed=1, null=True, chunksize=1)
+        assert(allclose(pvals_chunked.map(lambda (_, v): v).collect(), pvals))
+        assert(allclose(nulls_chunked.map(lambda (_, v): v).collect(), nulls))
+        perms = permutations(9, 20, 1)
+        for p in range(0, 20):
+            assert(allclose(nulls[:, p], [abs(corrcoef(y, sig[perms[p]])[0, 1]) for y in data_local]))
+
+        method = SigProcessingMethod.load("crosscorr", sigfile=sig, lag=2)
+        pvals = array(method.permtest(data, nperm=20, seed=1).map(lambda (_, v): v).collect())
+        assert(pvals.shape == (2, 5))
+        assert(pvals[0, 2] == 1.0 / 21)
+
 
 
 
@@ -0,0 +1,188 @@
+import os
+import argparse
+import glob
+from numpy import sum, array, zeros, ones, sqrt, bincount, where, argsort, newaxis, random
+from numpy.linalg import norm
+from thunder.clustering.kmeans import labelstats
+from thunder.util.load import load
+from thunder.util.matrixrdd import matrixstack_iterator
+from thunder.util.save import save
+from pyspark import SparkContext
+
+
+def bisect(x, nodes, centers, slots):
+    """Assign the points in a block that belong to nodes being split
+    to the closer of the two child centers of their node
+
+    :param x: array of points (one per row)
+    :param nodes: node of each point
+    :param centers: array of child centers, two rows for each node being split
+    :param slots: position of each node among the nodes being split (-1 if not split)
+
+    :return sides: for each point 2 * position + 0 or 1 for its child (-1 if its node is not split)
+    """
+    j = slots[nodes]
+    sides = -ones(len(x), dtype=int)
+    sel = (j >= 0).nonzero()[0]
+    if len(sel) > 0:
+        d0 = sum((x[sel] - centers[2 * j[sel]]) ** 2, axis=1)
+        d1 = sum((x[sel] - centers[2 * j[sel] + 1]) ** 2, axis=1)
+        sides[sel] = 2 * j[sel] + (d1 < d0)
+    return sides
+
+
+def slotstats(x, norms, slots, nslots):
+    """Return the sum, count and sum of squared norms of the points in a block in each slot
+    (points with a negative slot are ignored)"""
+
+    sel = slots >= 0
+    sums, counts = labelstats(x[sel], slots[sel], nslots)
+    return sums, counts, bincount(slots[sel], norms[sel], minlength=nslots)
+
+
+def descend(x, centers, children):
+    """Find the leaf of each point in a block, by going down the tree
+    from the root to the closer of the two children at each node
+
+    :param x: array of points (one per row)
+    :param centers: array of the centers of all nodes
+    :param children: first child of each node (-1 for leaves), the second child is the next node
+
+    :return nodes: the leaf of each point
+    """
+    nodes = zeros(len(x), dtype=int)
+    sel = (children[nodes] >= 0).nonzero()[0]
+    while len(sel) > 0:
+        first = children[nodes[sel]]
+        d0 = sum((x[sel] - centers[first]) ** 2, axis=1)
+        d1 = sum((x[sel] - centers[first + 1]) ** 2, axis=1)
+        nodes[sel] = first + (d1 < d0)
+        sel = sel[children[nodes[sel]] >= 0]
+    return nodes
+
+
+def bisectingkmeans(data, k, maxiter=20, tol=0.001, seed=0):
+    """Perform bisecting (hierarchical) kmeans clustering
+
+    Starting from a single cluster, clusters are recursively split in
+    two with 2-means on their own points. All clusters being split at the
+    same level of the tree are handled together, so each 2-means iteration
+    is one pass through the data for the whole level. At each level
+    every cluster is split, unless that would give more than k clusters, in
+    which case only those with the largest within-cluster cost are split.
+    The current node of every point is kept alongside the blocks in a cached RDD
+
+    :param data: RDD of data points as key value pairs
+    :param k: number of clusters
+    :param maxiter: maximum number of 2-means iterations per level (default = 20)
+    :param tol: change tolerance for stopping 2-means (default = 0.001)
+    :param seed: seed for the initial split directions (default = 0, for no seed)
+
+    :return labels: RDD with labels for each data point (indexing the leaves in order of node)
+    :return centers: array of cluster centroids (one per leaf)
+    :return tree: list of nodes, each a dictionary with "center", "count", "cost" (within-cluster
+        sum of squared distances) and "children" (pair of node indices, None for leaves), the root is node 0
+    """
+    rng = random.RandomState(seed) if seed != 0 else random.RandomState()
+
+    state = data.mapPartitions(matrixstack_iterator).map(
+        lambda (_, x): (x, sum(x ** 2, axis=1), zeros(len(x), dtype=int))).cache()
+
+    sums, counts, sumnorms = state.map(lambda (x, norms, nodes): (sum(x, axis=0), len(x), sum(norms))).reduce(
+        lambda x, y: (x[0] + y[0], x[1] + y[1], x[2] + y[2]))
+    center = sums / counts
+    tree = [{"center": center, "count": counts, "cost": sumnorms - counts * sum(center ** 2), "children": None}]
+    nleaves = 1
+
+    while nleaves < k:
+        leaves = [i for i in range(0, len(tree)) if (tree[i]["children"] is None) & (tree[i]["cost"] > 0)]
+        if len(leaves) == 0:
+            break
+        split = [leaves[i] for i in argsort([-tree[i]["cost"] for i in leaves])[0:k - nleaves]]
+        nsplit = len(split)
+        slots = -ones(len(tree), dtype=int)
+        slots[split] = range(0, nsplit)
+
+        # start each split from a random direction through the center,
+        # at the root mean squared distance of the points from the center
+        c = zeros((2 * nsplit, len(center)))
+        for (j, i) in enumerate(split):
+            direction = rng.randn(len(center))
+            direction *= sqrt(tree[i]["cost"] / tree[i]["count"]) / norm(direction)
+            c[2 * j] = tree[i]["center"] + direction
+            c[2 * j + 1] = tree[i]["center"] - direction
+
+        # do 2-means for all the clusters being split at once
+        for iter in range(0, maxiter):
+            cb = data.context.broadcast((c, slots))
+            sums, counts, _ = state.map(lambda (x, norms, nodes): slotstats(
+                x, norms, bisect(x, nodes, cb.value[0], cb.value[1]), 2 * nsplit)).reduce(
+                lambda x, y: (x[0] + y[0], x[1] + y[1], x[2] + y[2]))
+            cb.unpersist()
+            newc = c.copy()
+            newc[counts > 0] = sums[counts > 0] / counts[counts > 0, newaxis]
+            tempdist = sum((newc - c) ** 2)
+            c = newc
+            if tempdist <= tol:
+                break
+
+        # move points to the new child nodes
+        first = len(tree)
+        cb = data.context.broadcast((c, slots))
+        newstate = state.map(lambda (x, norms, nodes): (x, norms, where(
+            cb.value[1][nodes] >= 0, first + bisect(x, nodes, cb.value[0], cb.value[1]), nodes))).cache()
+        sums, counts, sumnorms = newstate.map(lambda (x, norms, nodes): slotstats(
+            x, norms, where(nodes >= first, nodes - first, -1), 2 * nsplit)).reduce(
+            lambda x, y: (x[0] + y[0], x[1] + y[1], x[2] + y[2]))
+        state.unpersist()
+        cb.unpersist()
+        state = newstate
+
+        costs = sumnorms - 2 * sum(c * sums, axis=1) + counts * sum(c ** 2, axis=1)
+        for (j, i) in enumerate(split):
+            tree[i]["children"] = (first + 2 * j, first + 2 * j + 1)
+        for j in range(0, 2 * nsplit):
+            tree.append({"center": c[j], "count": counts[j], "cost": costs[j], "children": None})
+        nleaves += nsplit
+
+    state.unpersist()
+
+    leaves = [i for i in range(0, len(tree)) if tree[i]["children"] is None]
+    centers = array([tree[i]["center"] for i in leaves])
+    flat = zeros(len(tree), dtype=int)
+    flat[leaves] = range(0, len(leaves))
+    allcenters = array([node["center"] for node in tree])
+    children = array([node["children"][0] if node["children"] is not None else -1 for node in tree])
+
+    labels = data.mapPartitions(matrixstack_iterator).flatMap(
+        lambda (keys, x): zip(keys, flat[descend(x, allcenters, children)].tolist()))
+
+    return labels, centers, tree
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="do bisecting kmeans clustering")
+    parser.add_argument("master", type=str)
+    parser.add_argument("datafile", type=str)
+    parser.add_argument("outputdir", type=str)
+    parser.add_argument("k", type=int)
+    parser.add_argument("--maxiter", type=int, default=20, required=False)
+    parser.add_argument("--tol", type=float, default=0.001, required=False)
+    parser.add_argument("--seed", type=int, default=0, required=False)
+    parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
+
+    args = parser.parse_args()
+
+    sc = SparkContext(args.master, "bisectingkmeans")
+
+    if args.master != "local":
+        egg = glob.glob(os.path.join(os.environ['THUNDER_EGG'], "*.egg"))
+        sc.addPyFile(egg[0])
+
+    data = load(sc, args.datafile, args.preprocess).cache()
+
+    labels, centers, tree = bisectingkmeans(data, k=args.k, maxiter=args.maxiter, tol=args.tol, seed=args.seed)
+
+    outputdir = args.outputdir + "-bisectingkmeans"
+
+    save(labels, outputdir, "labels", "matlab")
+    save(centers, outputdir, "centers", "matlab")
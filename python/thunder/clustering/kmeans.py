@@ -1,9 +1,12 @@
 import os
 import argparse
 import glob
-from numpy import sum
-from thunder.util.load import load
+from numpy import sum, array, dot, transpose, argmin, arange, shape, newaxis, maximum, minimum, vstack, \
+    bincount, allclose, random, zeros, sqrt, inf, cumsum
+from thunder.util.load import load, loadresult
+from thunder.util.matrixrdd import matrixstack_iterator
 from thunder.util.save import save
+from thunder.util.checkpoint import Checkpoint
 from pyspark import SparkContext
 
 
@@ -20,37 +23,418 @@ def closestpoint(p, centers):
     return bestindex
 
 
-def kmeans(data, k, maxiter=20, tol=0.001):
+def closestcenters(x, norms, centers, centernorms):
+    """Return the index of the closest center for each point in a block,
+    computing all squared distances at once as |x|^2 - 2 x c' + |c|^2
+
+    :param x: array of points (one per row)
+    :param norms: squared norms of the points
+    :param centers: array of centers (one per row)
+    :param centernorms: squared norms of the centers
+    """
+    dists = norms[:, newaxis] - 2 * dot(x, transpose(centers)) + centernorms
+    return argmin(dists, axis=1)
+
+
+def labelstats(x, labels, k):
+    """Return the sum and count of the points in a block with each label"""
+
+    members = (labels[:, newaxis] == arange(k)).astype(float)
+    return dot(transpose(members), x), sum(members, axis=0)
+
+
+def centerstats(x, norms, centers, centernorms):
+    """Return the sum and count of the points in a block closest to each center"""
+
+    return labelstats(x, closestcenters(x, norms, centers, centernorms), shape(centers)[0])
+
+
+def closesttwo(x, norms, centers, centernorms):
+    """Return the index of the closest center for each point in a block,
+    along with the (not squared) distances to the closest and second closest centers
+
+    :return labels: index of the closest center
+    :return upper: distance to the closest center
+    :return lower: distance to the second closest center (inf if there is only one)
+    """
+    dists = sqrt(maximum(norms[:, newaxis] - 2 * dot(x, transpose(centers)) + centernorms, 0))
+    labels = argmin(dists, axis=1)
+    rows = arange(len(x))
+    upper = dists[rows, labels]
+    dists[rows, labels] = inf
+    return labels, upper, dists.min(axis=1)
+
+
+def boundsupdate(x, norms, labels, upper, lower, centers, centernorms, shift, half):
+    """Update the labels of a block of points after the centers have moved,
+    using bounds on the distances to skip most distance computations (Hamerly's method)
+
+    The upper bound on the distance to the assigned center grows by that
+    center's displacement, and the lower bound on the distance to any other
+    center shrinks by the largest displacement. A point can only change
+    label if its upper bound exceeds both its lower bound and half the distance
+    from its center to the nearest other center; then the upper bound is
+    tightened, and only if that fails are distances to all centers computed
+
+    :param shift: distance each center moved since the bounds were computed
+    :param half: half the distance from each center to its nearest other center
+
+    :return labels, upper, lower: the updated labels and bounds
+    """
+    labels = labels.copy()
+    upper = upper + shift[labels]
+    lower = lower - shift.max()
+
+    bound = maximum(half[labels], lower)
+    check = (upper > bound).nonzero()[0]
+    if len(check) > 0:
+        assigned = labels[check]
+        upper[check] = sqrt(maximum(norms[check] - 2 * sum(x[check] * centers[assigned], axis=1) +
+                                    centernorms[assigned], 0))
+        check = check[upper[check] > bound[check]]
+    if len(check) > 0:
+        labels[check], upper[check], lower[check] = closesttwo(x[check], norms[check], centers, centernorms)
+
+    return labels, upper, lower
+
+
+def samplestats(x, norms, centers, centernorms, fraction, rng):
+    """Return the sum and count of a random sample of the points in a block
+    closest to each center
+
+    :param fraction: expected fraction of points to sample
+    :param rng: numpy RandomState
+    """
+    sample = rng.rand(len(x)) < fraction
+    return centerstats(x[sample], norms[sample], centers, centernorms)
+
+
+def mindists(x, norms, centers, centernorms):
+    """Return the squared distance from each point in a block to its closest center"""
+
+    dists = norms[:, newaxis] - 2 * dot(x, transpose(centers)) + centernorms
+    return maximum(dists.min(axis=1), 0)
+
+
+def kmeansplusplus(points, weights, k, rng, maxiter=30):
+    """Choose k centers from a small set of weighted points using kmeans++
+    seeding followed by (weighted) kmeans iterations, all done locally
+
+    :param points: array of candidate points (one per row)
+    :param weights: weight of each point
+    :param k: number of centers
+    :param rng: numpy RandomState
+    :param maxiter: maximum number of kmeans iterations (default = 30)
+
+    :return centers: array of k centers
+    """
+    norms = sum(points ** 2, axis=1)
+    inds = [rng.choice(len(points), p=weights / sum(weights))]
+    dists = mindists(points, norms, points[inds], norms[inds])
+    for i in range(1, k):
+        prob = weights * dists
+        if sum(prob) == 0:
+            prob = weights
+        inds.append(rng.choice(len(points), p=prob / sum(prob)))
+        dists = mindists(points, norms, points[inds], norms[inds])
+
+    centers = points[inds]
+    for i in range(0, maxiter):
+        closest = closestcenters(points, norms, centers, sum(centers ** 2, axis=1))
+        members = (closest[:, newaxis] == arange(k)) * weights[:, newaxis]
+        counts = sum(members, axis=0)
+        newcenters = centers.copy()
+        newcenters[counts > 0] = dot(transpose(members), points)[counts > 0] / counts[counts > 0, newaxis]
+        if allclose(newcenters, centers):
+            break
+        centers = newcenters
+
+    return centers
+
+
+def kmeansparallel(data, blocks, k, rounds=5, seed=0):
+    """Choose initial centers using scalable kmeans++ (kmeans||)
+
+    Starting from one random point, each round samples about 2k more
+    candidates with probability proportional to their squared distance
+    from the current candidates. The candidates are then weighted by
+    the number of points closest to each, and reduced to k centers
+    with a local kmeans++. Distances to the closest candidate are
+    cached along with the blocks, and updated each round
+
+    :param data: RDD of data points as key value pairs
+    :param blocks: RDD of blocks of points with their squared norms
+    :param k: number of centers
+    :param rounds: number of sampling rounds (default = 5)
+    :param seed: seed for the random sampling (default = 0, for no seed)
+
+    :return centers: list of k initial centers
+    """
+    if seed == 0:
+        seed = random.randint(1, 1000000)
+    rng = random.RandomState(seed)
+    oversample = 2 * k
+
+    candidates = array([data.takeSample(False, 1, seed)[0][1]])
+    cb = data.context.broadcast((candidates, sum(candidates ** 2, axis=1)))
+    state = blocks.map(lambda (x, norms): (x, norms, mindists(x, norms, cb.value[0], cb.value[1]))).cache()
+    cost = state.map(lambda (x, norms, dists): sum(dists)).sum()
+
+    for r in range(0, rounds):
+        if cost == 0:
+            break
+        # sample new candidates from each block using the cached distances
+        sampled = state.mapPartitionsWithIndex(lambda i, iterator: [
+            x[random.RandomState([seed, r, i]).rand(len(dists)) < oversample * dists / cost]
+            for (x, norms, dists) in iterator]).filter(lambda x: len(x) > 0).collect()
+        if len(sampled) == 0:
+            continue
+        new = vstack(sampled)
+        candidates = vstack((candidates, new))
+        # update the distances to the closest candidate
+        nb = data.context.broadcast((new, sum(new ** 2, axis=1)))
+        newstate = state.map(lambda (x, norms, dists): (
+            x, norms, minimum(dists, mindists(x, norms, nb.value[0], nb.value[1])))).cache()
+        cost = newstate.map(lambda (x, norms, dists): sum(dists)).sum()
+        state.unpersist()
+        nb.unpersist()
+        state = newstate
+
+    state.unpersist()
+    cb.unpersist()
+
+    if len(candidates) <= k:
+        extra = map(lambda (_, v): v, data.takeSample(False, k - len(candidates), seed))
+        return list(candidates) + extra
+
+    # weight candidates by the number of points closest to each
+    cb = data.context.broadcast((candidates, sum(candidates ** 2, axis=1)))
+    weights = blocks.map(lambda (x, norms): bincount(closestcenters(x, norms, cb.value[0], cb.value[1]),
+                                                     minlength=len(candidates))).sum()
+    cb.unpersist()
+
+    return list(kmeansplusplus(candidates, weights.astype(float), k, rng))
+
+
+def kmeans(data, k, maxiter=20, tol=0.001, checkpoint=None, warmstart=None, init="first", seed=0,
+           minibatch=None, accelerate=False):
     """Perform kmeans clustering
 
+    Points are stacked into blocks (with their squared norms)
+    so that each iteration assigns points and sums them by cluster
+    with a few array operations per block
+
+    In mini-batch mode each iteration only uses a random sample of
+    each block, and each center moves towards the mean of its sampled
+    points with a learning rate of one over the total number of points
+    assigned to it so far. Labels are still computed with a full
+    assignment pass, but only when the labels RDD is used
+
+    In accelerated mode (ignored in mini-batch mode) the labels and bounds on
+    the distances of each point to its center and to the other centers are
+    kept alongside the blocks in a cached RDD, and updated each iteration
+    using how far the centers moved, so that most distance computations
+    are skipped once few points change cluster. Results are the same as
+    for full iterations
+
     :param data: RDD of data points as key value pairs
     :param k: number of clusters
     :param maxiter: maximum number of iterations (default = 20)
     :param tol: change tolerance for stopping algorithm (default = 0.001)
+    :param checkpoint: Checkpoint for saving and resuming the state (default = None)
+    :param warmstart: initial centers, as an array or the location of
+        centers saved by a previous run (default = None)
+    :param init: initialization without warmstart, "first" (the first k data points)
+        or "k-means||" (scalable kmeans++) (default = "first")
+    :param seed: seed for "k-means||" initialization and mini-batch sampling (default = 0, for no seed)
+    :param minibatch: fraction of each block to sample per iteration (default = None, for full iterations)
+    :param accelerate: whether to use distance bounds to skip distance computations (default = False)
 
     :return labels: RDD with labels for each data point
     :return centers: array of cluster centroids
     """
-    centers = map(lambda (_, v): v, data.take(k))
+    blocks = data.mapPartitions(matrixstack_iterator).map(lambda (_, x): (x, sum(x ** 2, axis=1))).cache()
 
     tempdist = 1.0
     iter = 0
+    errvec = []
+    state = None
+    total = zeros(k)
+    bounds = None
+
+    if (minibatch is not None) & (seed == 0):
+        seed = random.randint(1, 1000000)
+
+    if checkpoint is not None:
+        state = checkpoint.restore("kmeans")
+
+    if state is not None:
+        centers, tempdist, iter, errvec = state["centers"], state["tempdist"], state["iter"], state["errvec"]
+        total = state.get("total", total)
+    elif warmstart is not None:
+        centers = list(loadresult(warmstart, "centers"))
+    elif init == "k-means||":
+        centers = kmeansparallel(data, blocks, k, seed=seed)
+    else:
+        centers = map(lambda (_, v): v, data.take(k))
 
     while (tempdist > tol) & (iter < maxiter):
-        closest = data.map(lambda (_, v): v).map(lambda p: (closestpoint(p, centers), (p, 1)))
-        pointstats = closest.reduceByKey(lambda (x1, y1), (x2, y2): (x1 + x2, y1 + y2))
-        newpoints = pointstats.map(lambda (x, (y, z)): (x, y / z)).collect()
+        c = array(centers)
+        cb = data.context.broadcast((c, sum(c ** 2, axis=1)))
+        if minibatch is not None:
+            stats = blocks.mapPartitionsWithIndex(lambda i, iterator: [
+                samplestats(x, norms, cb.value[0], cb.value[1], minibatch, random.RandomState([seed, iter, i]))
+                for (x, norms) in iterator])
+        elif accelerate:
+            if bounds is None:
+                newbounds = blocks.map(lambda (x, norms): (x, norms) + closesttwo(
+                    x, norms, cb.value[0], cb.value[1]))
+            else:
+                between = sqrt(maximum(sum(c ** 2, axis=1)[:, newaxis] - 2 * dot(c, transpose(c)) +
+                                       sum(c ** 2, axis=1), 0))
+                between[arange(k), arange(k)] = inf
+                sb = data.context.broadcast((sqrt(sum((c - previous) ** 2, axis=1)), between.min(axis=1) / 2))
+                newbounds = bounds.map(lambda (x, norms, labels, upper, lower): (x, norms) + boundsupdate(
+                    x, norms, labels, upper, lower, cb.value[0], cb.value[1], sb.value[0], sb.value[1]))
+            newbounds.cache()
+            if checkpoint is not None:
+                # the bounds are derived from the previous bounds, truncate their growing lineage
+                if (iter + 1) % checkpoint.interval == 0:
+                    checkpoint.truncate(newbounds)
+            stats = newbounds.map(lambda (x, norms, labels, upper, lower): labelstats(x, labels, k))
+        else:
+            stats = blocks.map(lambda (x, norms): centerstats(x, norms, cb.value[0], cb.value[1]))
+        sums, counts = stats.reduce(lambda x, y: (x[0] + y[0], x[1] + y[1]))
+        if (minibatch is None) & accelerate:
+            if bounds is not None:
+                bounds.unpersist()
+                sb.unpersist()
+            bounds = newbounds
+            previous = c
+        cb.unpersist()
+        if minibatch is None:
+            newpoints = [(i, sums[i] / counts[i]) for i in range(0, len(centers)) if counts[i] > 0]
+        else:
+            total += counts
+            newpoints = [(i, centers[i] + (sums[i] - counts[i] * centers[i]) / total[i])
+                         for i in range(0, len(centers)) if counts[i] > 0]
         tempdist = sum(sum((centers[x] - y) ** 2) for (x, y) in newpoints)
 
         for (i, j) in newpoints:
             centers[i] = j
 
         iter += 1
+        errvec.append(tempdist)
+
+        if checkpoint is not None:
+            checkpoint.save("kmeans", iter, {"centers": centers, "tempdist": tempdist, "iter": iter, "errvec": errvec,
+                                             "total": total})
+
+    if bounds is not None:
+        bounds.unpersist()
+    blocks.unpersist()
 
-    labels = data.mapValues(lambda p: closestpoint(p, centers))
+    c = array(centers)
+    cnorms = sum(c ** 2, axis=1)
+    labels = data.mapPartitions(matrixstack_iterator).flatMap(
+        lambda (keys, x): zip(keys, closestcenters(x, sum(x ** 2, axis=1), c, cnorms).tolist()))
 
     return labels, centers
 
+
+def sweepstats(x, norms, centers, centernorms, segments):
+    """Return the sum and count of the points in a block closest to each center,
+    and the within-cluster cost, for several sets of centers stacked together
+
+    Distances to all centers are computed at once, and each set of
+    centers is then assigned using only its own columns
+
+    :param centers: array of all sets of centers stacked (one center per row)
+    :param segments: list of (start, stop) rows of each set of centers
+
+    :return stats: list of (sums, counts, cost) for each set of centers
+    """
+    dists = maximum(norms[:, newaxis] - 2 * dot(x, transpose(centers)) + centernorms, 0)
+    rows = arange(len(x))
+    stats = []
+    for (start, stop) in segments:
+        labels = argmin(dists[:, start:stop], axis=1)
+        sums, counts = labelstats(x, labels, stop - start)
+        stats.append((sums, counts, sum(dists[rows, start + labels])))
+    return stats
+
+
+def kmeanssweep(data, ks, nrestarts=1, maxiter=20, tol=0.001, seed=0):
+    """Perform kmeans clustering for several numbers of clusters
+    and several random restarts, all in the same passes through the data
+
+    The centers of all configurations are stacked into one array, so that
+    each iteration computes the distances of every point to all centers at
+    once. Configurations are dropped from the stack as they converge.
+    Restart r of every k starts from the first k points of the same random sample
+
+    :param data: RDD of data points as key value pairs
+    :param ks: list of numbers of clusters
+    :param nrestarts: number of random restarts for each k (default = 1)
+    :param maxiter: maximum number of iterations (default = 20)
+    :param tol: change tolerance for stopping each configuration (default = 0.001)
+    :param seed: seed for choosing the initial centers (default = 0, for no seed)
+
+    :return labels: RDD with an array of labels for each data point (one per configuration)
+    :return centers: list of arrays of cluster centroids (one per configuration)
+    :return costs: array of within-cluster sums of squared distances (one per configuration)
+    :return configs: list of (k, restart) for each configuration
+    """
+    if seed == 0:
+        seed = random.randint(1, 1000000)
+
+    configs = [(k, r) for k in ks for r in range(0, nrestarts)]
+    sample = array(map(lambda (_, v): v, data.takeSample(False, max(ks) * nrestarts, seed)))
+    centers = [sample[r * k:(r + 1) * k].copy() for (k, r) in configs]
+
+    blocks = data.mapPartitions(matrixstack_iterator).map(lambda (_, x): (x, sum(x ** 2, axis=1))).cache()
+
+    active = range(0, len(configs))
+    iter = 0
+
+    while (len(active) > 0) & (iter < maxiter):
+        c = vstack([centers[i] for i in active])
+        bounds = cumsum([0] + [len(centers[i]) for i in active])
+        segments = zip(bounds[:-1], bounds[1:])
+        cb = data.context.broadcast((c, sum(c ** 2, axis=1), segments))
+        stats = blocks.map(lambda (x, norms): sweepstats(x, norms, cb.value[0], cb.value[1], cb.value[2])).reduce(
+            lambda x, y: [(a[0] + b[0], a[1] + b[1], a[2] + b[2]) for (a, b) in zip(x, y)])
+        cb.unpersist()
+
+        converged = []
+        for (i, (sums, counts, cost)) in zip(active, stats):
+            keep = counts > 0
+            newcenters = centers[i].copy()
+            newcenters[keep] = sums[keep] / counts[keep, newaxis]
+            if sum((newcenters - centers[i]) ** 2) <= tol:
+                converged.append(i)
+            centers[i] = newcenters
+        active = [i for i in active if i not in converged]
+        iter += 1
+
+    # compute the final assignments and costs of every configuration
+    c = vstack(centers)
+    bounds = cumsum([0] + [len(x) for x in centers])
+    segments = zip(bounds[:-1], bounds[1:])
+    cb = data.context.broadcast((c, sum(c ** 2, axis=1), segments))
+    costs = array(blocks.map(lambda (x, norms): [s[2] for s in sweepstats(
+        x, norms, cb.value[0], cb.value[1], cb.value[2])]).reduce(lambda x, y: [a + b for (a, b) in zip(x, y)]))
+    cb.unpersist()
+    blocks.unpersist()
+
+    cnorms = sum(c ** 2, axis=1)
+    labels = data.mapPartitions(matrixstack_iterator).flatMap(
+        lambda (keys, x): zip(keys, transpose([argmin(
+            sum(x ** 2, axis=1)[:, newaxis] - 2 * dot(x, transpose(c[start:stop])) + cnorms[start:stop], axis=1)
+            for (start, stop) in segments])))
+
+    return labels, centers, costs, configs
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="do kmeans clustering")
     parser.add_argument("master", type=str)
@@ -60,6 +444,14 @@ if __name__ == "__main__":
     parser.add_argument("--maxiter", type=float, default=20, required=False)
     parser.add_argument("--tol", type=float, default=0.001, required=False)
     parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
+    parser.add_argument("--checkpointdir", type=str, default=None, required=False)
+    parser.add_argument("--checkpointinterval", type=int, default=10, required=False)
+    parser.add_argument("--resume", action="store_true", default=False, required=False)
+    parser.add_argument("--warmstart", type=str, default=None, required=False)
+    parser.add_argument("--init", choices=("first", "k-means||"), default="first", required=False)
+    parser.add_argument("--seed", type=int, default=0, required=False)
+    parser.add_argument("--minibatch", type=float, default=None, required=False)
+    parser.add_argument("--accelerate", action="store_true", default=False, required=False)
 
     args = parser.parse_args()
 
@@ -71,7 +463,14 @@ if __name__ == "__main__":
 
     data = load(sc, args.datafile, args.preprocess).cache()
 
-    labels, centers = kmeans(data, k=args.k, maxiter=args.maxiter, tol=args.tol)
+    if args.checkpointdir is not None:
+        checkpoint = Checkpoint(args.checkpointdir, args.checkpointinterval, args.resume)
+    else:
+        checkpoint = None
+
+    labels, centers = kmeans(data, k=args.k, maxiter=args.maxiter, tol=args.tol, checkpoint=checkpoint,
+                             warmstart=args.warmstart, init=args.init, seed=args.seed,
+                             minibatch=args.minibatch, accelerate=args.accelerate)
 
     outputdir = args.outputdir + "-kmeans"
 
@@ -0,0 +1,205 @@
+import os
+import argparse
+import glob
+from numpy import sum, array, zeros, newaxis, random
+from thunder.clustering.kmeans import closestcenters, centerstats
+from thunder.util.load import loadbatches
+from thunder.util.matrixrdd import matrixstack_iterator
+from thunder.util.save import save
+from thunder.util.checkpoint import Checkpoint
+from pyspark import SparkContext
+
+
+class StreamingKMeansModel(object):
+    """Class for kmeans cluster centers, along with the current
+    number of points assigned to each cluster (for streaming algorithms)
+    """
+
+    def __init__(self, centers, counts):
+        """Create model
+
+        :param centers: array of cluster centers (one per row)
+        :param counts: number of points assigned to each cluster so far
+        """
+        self.centers = centers
+        self.counts = counts
+
+    def predict(self, data):
+        """Assign each data point to its closest cluster center
+
+        :param data: RDD of data points as key value pairs
+        :return labels: RDD with labels for each data point
+        """
+        c = self.centers
+        cnorms = sum(c ** 2, axis=1)
+        return data.mapPartitions(matrixstack_iterator).flatMap(
+            lambda (keys, x): zip(keys, closestcenters(x, sum(x ** 2, axis=1), c, cnorms).tolist()))
+
+
+class StreamingKMeans(object):
+    """Class for kmeans clustering on streaming data with support
+    for mini batch and forgetful algorithms
+
+    All data points are assumed to belong to one of k clusters,
+    whose centers are learned as new batches of data arrive, so all
+    data must have the same dimensionality
+
+    If a = 1 this is mini batch kmeans, where every data point counts
+    equally (a running count of the points per cluster is kept). If a < 1
+    this is forgetful kmeans, where each new batch moves the centers
+    a fraction a of the way towards the batch means, so more recent
+    data are weighted more heavily. The weighting is per batch, so the number
+    of data points per batch should be approximately constant
+    """
+
+    def __init__(self, k=2, d=5, a=1.0, maxiter=1, initmode="gauss", seed=0):
+        """Create streaming kmeans
+
+        :param k: number of clusters (default = 2)
+        :param d: number of dimensions per data point (default = 5)
+        :param a: update rule, 1 for mini batch, < 1 for forgetful (default = 1.0)
+        :param maxiter: number of iterations per batch (default = 1)
+        :param initmode: random initialization of the centers before any data are seen,
+            "gauss" for gaussian or "pos" for positive uniform (default = "gauss")
+        :param seed: seed for the random initialization (default = 0, for no seed)
+        """
+        if initmode not in ("gauss", "pos"):
+            raise Exception("initmode must be gauss or pos")
+        self.k = k
+        self.d = d
+        self.a = a
+        self.maxiter = maxiter
+        self.initmode = initmode
+        self.seed = seed
+
+    def init(self):
+        """Initialize random cluster centers
+
+        :return model: StreamingKMeansModel with no points assigned
+        """
+        if self.seed != 0:
+            random.seed(self.seed)
+        if self.initmode == "gauss":
+            centers = random.randn(self.k, self.d)
+        else:
+            centers = random.rand(self.k, self.d)
+        return StreamingKMeansModel(centers, zeros(self.k))
+
+    def update(self, data, model):
+        """Update the cluster centers with a new batch of data
+
+        :param data: RDD of data points as key value pairs
+        :param model: StreamingKMeansModel from the previous batch
+        :return model: the updated StreamingKMeansModel
+        """
+        centers = array(model.centers, dtype=float)
+        counts = array(model.counts, dtype=float)
+
+        blocks = data.mapPartitions(matrixstack_iterator).map(lambda (_, x): (x, sum(x ** 2, axis=1)))
+        if self.maxiter > 1:
+            blocks.cache()
+
+        for i in range(0, self.maxiter):
+            cb = data.context.broadcast((centers, sum(centers ** 2, axis=1)))
+            sums, n = blocks.map(lambda (x, norms): centerstats(x, norms, cb.value[0], cb.value[1])).reduce(
+                lambda x, y: (x[0] + y[0], x[1] + y[1]))
+            cb.unpersist()
+            keep = n > 0
+            if self.a == 1:
+                # mean of both old and new points
+                total = counts[keep] + n[keep]
+                centers[keep] = (centers[keep] * counts[keep, newaxis] + sums[keep]) / total[:, newaxis]
+                counts += n
+            else:
+                # move towards the new mean with forgetting factor a
+                centers[keep] += self.a * (sums[keep] / n[keep, newaxis] - centers[keep])
+
+        if self.maxiter > 1:
+            blocks.unpersist()
+
+        return StreamingKMeansModel(centers, counts)
+
+
+def streamingkmeans(batches, k, d, a=1.0, maxiter=1, initmode="gauss", seed=0, checkpoint=None, outputdir=None):
+    """Perform kmeans clustering on data as they arrive,
+    updating the centers with each new batch of data
+
+    :param batches: iterable of RDDs of data points as key value pairs
+    :param k: number of clusters
+    :param d: number of dimensions per data point
+    :param a: update rule, 1 for mini batch, < 1 for forgetful (default = 1.0)
+    :param maxiter: number of iterations per batch (default = 1)
+    :param initmode: random initialization of the centers, "gauss" or "pos" (default = "gauss")
+    :param seed: seed for the random initialization (default = 0, for no seed)
+    :param checkpoint: Checkpoint for saving and resuming the model between batches (default = None)
+    :param outputdir: location to save centers after each batch (default = None, for no saving)
+
+    :return labels: RDD with labels for each data point of the most recent batch
+    :return model: StreamingKMeansModel with the current centers and counts
+    """
+    algorithm = StreamingKMeans(k, d, a, maxiter, initmode, seed)
+
+    nbatches = 0
+    state = None
+
+    if checkpoint is not None:
+        state = checkpoint.restore("streamingkmeans")
+
+    if state is not None:
+        model = StreamingKMeansModel(state["centers"], state["counts"])
+        nbatches = state["nbatches"]
+    else:
+        model = algorithm.init()
+
+    labels = None
+
+    for data in batches:
+        model = algorithm.update(data, model)
+        labels = model.predict(data)
+        nbatches += 1
+        if checkpoint is not None:
+            checkpoint.save("streamingkmeans", nbatches,
+                            {"centers": model.centers, "counts": model.counts, "nbatches": nbatches})
+        if outputdir is not None:
+            save(model.centers, outputdir, "centers", "matlab")
+
+    return labels, model
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="do kmeans clustering on data as they arrive")
+    parser.add_argument("master", type=str)
+    parser.add_argument("datadir", type=str)
+    parser.add_argument("outputdir", type=str)
+    parser.add_argument("k", type=int)
+    parser.add_argument("d", type=int)
+    parser.add_argument("--alpha", type=float, default=1.0, required=False)
+    parser.add_argument("--maxiter", type=int, default=1, required=False)
+    parser.add_argument("--initmode", choices=("gauss", "pos"), default="gauss", required=False)
+    parser.add_argument("--seed", type=int, default=0, required=False)
+    parser.add_argument("--interval", type=float, default=1.0, required=False)
+    parser.add_argument("--timeout", type=float, default=None, required=False)
+    parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
+    parser.add_argument("--checkpointdir", type=str, default=None, required=False)
+    parser.add_argument("--checkpointinterval", type=int, default=1, required=False)
+    parser.add_argument("--resume", action="store_true", default=False, required=False)
+
+    args = parser.parse_args()
+
+    sc = SparkContext(args.master, "streamingkmeans")
+
+    if args.master != "local":
+        egg = glob.glob(os.path.join(os.environ['THUNDER_EGG'], "*.egg"))
+        sc.addPyFile(egg[0])
+
+    batches = loadbatches(sc, args.datadir, args.preprocess, interval=args.interval, timeout=args.timeout)
+
+    if args.checkpointdir is not None:
+        checkpoint = Checkpoint(args.checkpointdir, args.checkpointinterval, args.resume)
+    else:
+        checkpoint = None
+
+    outputdir = args.outputdir + "-streamingkmeans"
+
+    labels, model = streamingkmeans(batches, args.k, args.d, a=args.alpha, maxiter=args.maxiter,
+                                    initmode=args.initmode, seed=args.seed, checkpoint=checkpoint,
+                                    outputdir=outputdir)
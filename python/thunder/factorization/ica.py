@@ -1,15 +1,58 @@
 import os
 import argparse
 import glob
-from numpy import random, sqrt, zeros, real, dot, outer, diag, transpose
+from numpy import random, sqrt, zeros, ones, real, dot, diag, transpose, tanh, exp, shape, sum, mean, hstack, argmax
 from scipy.linalg import sqrtm, inv, orth
-from thunder.util.load import load
+from thunder.util.load import load, loadresult
 from thunder.util.save import save
+from thunder.util.checkpoint import Checkpoint
 from thunder.factorization.util import svd
-from pyspark import SparkContext
+from thunder.util.matrixrdd import matrixstack_iterator
+from pyspark import SparkContext, StorageLevel
 
 
-def ica(data, k, c, svdmethod="direct", maxiter=100, tol=0.000001, seed=0):
+def pow3update(x, b):
+    """Terms of the fixed point update for the pow3 non-linearity, g(u) = u^3,
+    for a block of whitened records (the derivative term is fixed at 3)
+    """
+    y = dot(x, b)
+    return dot(transpose(x), y ** 3), 3 * shape(x)[0] * ones(shape(b)[1])
+
+
+def logcoshupdate(x, b):
+    """Terms of the fixed point update for the logcosh non-linearity, g(u) = tanh(u),
+    for a block of whitened records
+    """
+    g = tanh(dot(x, b))
+    return dot(transpose(x), g), sum(1 - g ** 2, axis=0)
+
+
+def gaussupdate(x, b):
+    """Terms of the fixed point update for the gauss non-linearity, g(u) = u exp(-u^2/2),
+    for a block of whitened records
+    """
+    y = dot(x, b)
+    e = exp(-(y ** 2) / 2)
+    return dot(transpose(x), y * e), sum((1 - y ** 2) * e, axis=0)
+
+
+def consensus(bs):
+    """Select the consensus among several estimates of the
+    (orthonormal) un-mixing matrix in the whitened space,
+    the estimate whose components best match those of all others
+
+    :param bs: list of arrays, each with one component per column
+
+    :return b: the estimate with the highest average similarity to the others
+    """
+    if len(bs) == 1:
+        return bs[0]
+    similarity = [mean([mean(abs(dot(transpose(b1), b2)).max(axis=1)) for b2 in bs if b2 is not b1]) for b1 in bs]
+    return bs[argmax(similarity)]
+
+
+def ica(data, k, c, svdmethod="direct", maxiter=100, tol=0.000001, seed=0, storagelevel="MEMORY_ONLY",
+        nonlinearity="pow3", nrestarts=1, checkpoint=None, warmstart=None):
     """Perform independent components analysis
 
     :param: data: RDD of data points
@@ -17,43 +60,86 @@ def ica(data, k, c, svdmethod="direct", maxiter=100, tol=0.000001, seed=0):
     :param c: number of independent components to find
     :param maxiter: maximum number of iterations (default = 100)
     :param: tol: tolerance for change in estimate (default = 0.000001)
+    :param seed: seed for the random initialization (default = 0, for no seed)
+    :param storagelevel: Spark storage level for the whitened data (default = "MEMORY_ONLY")
+    :param nonlinearity: non-linearity for the updates, "pow3", "logcosh", or "gauss" (default = "pow3")
+    :param nrestarts: number of random starting points, updated together in each pass
+        over the data, returns the consensus solution (default = 1)
+    :param checkpoint: Checkpoint for saving and resuming the state (default = None)
+    :param warmstart: initial un-mixing matrix, as an array or the location of
+        w saved by a previous run, used for the first restart (default = None, for random)
 
     :return w: the mixing matrix
     :return: sigs: the independent components
 
     TODO: also return unmixing matrix
     """
+    update = ICA_NONLINEARITIES[nonlinearity]
+
     # get count
     n = data.count()
 
     # reduce dimensionality
-    scores, latent, comps = svd(data, k, meansubtract=0, method=svdmethod)
+    scores, latent, comps = svd(data, k, meansubtract=0, method=svdmethod, checkpoint=checkpoint)
 
-    # whiten data
+    # whiten data, stored as blocks of records so that it is computed only once
     whtmat = real(dot(inv(diag(latent/sqrt(n))), comps))
     unwhtmat = real(dot(transpose(comps), diag(latent/sqrt(n))))
-    wht = data.mapValues(lambda x: dot(whtmat, x))
+    wht = data.mapPartitions(matrixstack_iterator).map(lambda (_, x): dot(x, transpose(whtmat)))
+    wht.persist(getattr(StorageLevel, storagelevel))
 
-    # do multiple independent component extraction
+    # do multiple independent component extraction,
+    # optionally from several random starting points at once
     if seed != 0:
         random.seed(seed)
-    b = orth(random.randn(k, c))
-    b_old = zeros((k, c))
+    b = [orth(random.randn(k, c)) for r in range(0, nrestarts)]
+    if warmstart is not None:
+        # express the previous un-mixing matrix in the current whitened space
+        b[0] = transpose(dot(loadresult(warmstart, "w"), unwhtmat))
+        b[0] = dot(b[0], real(sqrtm(inv(dot(transpose(b[0]), b[0])))))
+    b_old = [zeros((k, c)) for r in range(0, nrestarts)]
     iter = 0
-    minabscos = 0
-    errvec = zeros(maxiter)
+    active = range(0, nrestarts)
+    errvec = zeros((nrestarts, maxiter))
 
-    while (iter < maxiter) & ((1 - minabscos) > tol):
+    if checkpoint is not None:
+        state = checkpoint.restore("ica")
+        if state is not None:
+            b, b_old, iter, active = state["b"], state["b_old"], state["iter"], state["active"]
+            done = min(iter, maxiter)
+            errvec[:, 0:done] = state["errvec"][:, 0:done]
+
+    while (iter < maxiter) & (len(active) > 0):
         iter += 1
-        # update rule for pow3 non-linearity (TODO: add others)
-        b = wht.map(lambda (_, v): v).map(lambda x: outer(x, dot(x, b) ** 3)).sum() / n - 3 * b
-        # make orthogonal
-        b = dot(b, real(sqrtm(inv(dot(transpose(b), b)))))
-        # evaluate error
-        minabscos = min(abs(diag(dot(transpose(b), b_old))))
-        # store results
-        b_old = b
-        errvec[iter-1] = (1 - minabscos)
+        # fixed point update, b = E[x g(x'b)] - E[g'(x'b)] b,
+        # with both expectations computed in a single pass
+        # for all restarts that have not yet converged
+        b_all = hstack([b[r] for r in active])
+        bb = data.context.broadcast(b_all)
+        xg, dg = wht.map(lambda x: update(x, bb.value)).reduce(lambda x, y: (x[0] + y[0], x[1] + y[1]))
+        bb.unpersist()
+        b_all = xg / n - b_all * (dg / n)
+        for (i, r) in enumerate(active):
+            # make orthogonal
+            b[r] = b_all[:, i*c:(i+1)*c]
+            b[r] = dot(b[r], real(sqrtm(inv(dot(transpose(b[r]), b[r])))))
+            # evaluate error
+            minabscos = min(abs(diag(dot(transpose(b[r]), b_old[r]))))
+            # store results
+            b_old[r] = b[r]
+            errvec[r, iter-1] = (1 - minabscos)
+        active = [r for r in active if errvec[r, iter-1] > tol]
+
+        if checkpoint is not None:
+            checkpoint.save("ica", iter, {"b": b, "b_old": b_old, "iter": iter, "active": active, "errvec": errvec})
+
+    # pick the consensus among the converged restarts (or all, if none converged)
+    converged = [r for r in range(0, nrestarts) if r not in active]
+    if len(converged) == 0:
+        converged = range(0, nrestarts)
+    b = consensus([b[r] for r in converged])
+
+    wht.unpersist()
 
     # get un-mixing matrix
     w = dot(transpose(b), whtmat)
@@ -63,6 +149,13 @@ def ica(data, k, c, svdmethod="direct", maxiter=100, tol=0.000001, seed=0):
 
     return w, sigs
 
+
+ICA_NONLINEARITIES = {
+    'pow3': pow3update,
+    'logcosh': logcoshupdate,
+    'gauss': gaussupdate
+}
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="do independent components analysis")
     parser.add_argument("master", type=str)
@@ -75,6 +168,14 @@ if __name__ == "__main__":
     parser.add_argument("--tol", type=float, default=0.000001, required=False)
     parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
     parser.add_argument("--seed", type=int, default=0, required=False)
+    parser.add_argument("--nonlinearity", choices=("pow3", "logcosh", "gauss"), default="pow3", required=False)
+    parser.add_argument("--nrestarts", type=int, default=1, required=False)
+    parser.add_argument("--storagelevel", choices=("MEMORY_ONLY", "MEMORY_ONLY_SER", "MEMORY_AND_DISK",
+                        "MEMORY_AND_DISK_SER", "DISK_ONLY"), default="MEMORY_ONLY", required=False)
+    parser.add_argument("--checkpointdir", type=str, default=None, required=False)
+    parser.add_argument("--checkpointinterval", type=int, default=10, required=False)
+    parser.add_argument("--resume", action="store_true", default=False, required=False)
+    parser.add_argument("--warmstart", type=str, default=None, required=False)
 
     args = parser.parse_args()
     
@@ -86,7 +187,14 @@ if __name__ == "__main__":
     
     data = load(sc, args.datafile, args.preprocess).cache()
 
-    w, sigs = ica(data, args.k, args.c, svdmethod=args.svdmethod, maxiter=args.maxiter, tol=args.tol, seed=args.seed)
+    if args.checkpointdir is not None:
+        checkpoint = Checkpoint(args.checkpointdir, args.checkpointinterval, args.resume)
+    else:
+        checkpoint = None
+
+    w, sigs = ica(data, args.k, args.c, svdmethod=args.svdmethod, maxiter=args.maxiter, tol=args.tol, seed=args.seed,
+                  storagelevel=args.storagelevel, nonlinearity=args.nonlinearity, nrestarts=args.nrestarts,
+                  checkpoint=checkpoint, warmstart=args.warmstart)
 
     outputdir = args.outputdir + "-ica"
 
@@ -0,0 +1,56 @@
+import os
+import argparse
+import glob
+from thunder.util.load import loadbatches
+from thunder.util.save import save
+from thunder.factorization.util import IncrementalSVD
+from pyspark import SparkContext
+
+
+def incrementalpca(batches, k, outputdir=None):
+    """Perform principal components analysis incrementally,
+    updating the estimate as each new batch of data arrives
+
+    :param batches: iterable of RDDs of data points as key value pairs
+    :param k: number of principal components to recover
+    :param outputdir: location to save comps and latent after each batch (default = None, for no saving)
+
+    :return comps: the k principal components (as array)
+    :return latent: the latent values
+    :return scores: the k scores for the most recent batch (as RDD)
+    """
+    model = IncrementalSVD(k)
+
+    scores, latent, comps = None, None, None
+
+    for data in batches:
+        scores, latent, comps = model.update(data)
+        if outputdir is not None:
+            save(comps, outputdir, "comps", "matlab")
+            save(latent, outputdir, "latent", "matlab")
+
+    return scores, latent, comps
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="do principal components analysis on data as they arrive")
+    parser.add_argument("master", type=str)
+    parser.add_argument("datadir", type=str)
+    parser.add_argument("outputdir", type=str)
+    parser.add_argument("k", type=int)
+    parser.add_argument("--interval", type=float, default=1.0, required=False)
+    parser.add_argument("--timeout", type=float, default=None, required=False)
+    parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
+
+    args = parser.parse_args()
+
+    sc = SparkContext(args.master, "incrementalpca")
+
+    if args.master != "local":
+        egg = glob.glob(os.path.join(os.environ['THUNDER_EGG'], "*.egg"))
+        sc.addPyFile(egg[0])
+
+    batches = loadbatches(sc, args.datadir, args.preprocess, interval=args.interval, timeout=args.timeout)
+
+    outputdir = args.outputdir + "-incrementalpca"
+
+    scores, latent, comps = incrementalpca(batches, args.k, outputdir)
@@ -3,23 +3,28 @@ import argparse
 import glob
 from thunder.util.load import load
 from thunder.util.save import save
+from thunder.util.checkpoint import Checkpoint
 from thunder.factorization.util import svd
 from pyspark import SparkContext
 
 
-def pca(data, k, svdmethod="direct"):
+def pca(data, k, svdmethod="direct", checkpoint=None, warmstart=None):
     """Perform principal components analysis
     using the singular value decomposition
 
     :param data: RDD of data points as key value pairs
     :param k: number of principal components to recover
     :param svdmethod: which svd algorithm to use (default = "direct")
+    :param checkpoint: Checkpoint for saving and resuming the state of the "em" method (default = None)
+    :param warmstart: initial components for the "em" method, as an array or the location of
+        comps saved by a previous run (default = None, for random)
 
     :return comps: the k principal components (as array)
     :return latent: the latent values
     :return scores: the k scores (as RDD)
     """
-    scores, latent, comps = svd(data, k, meansubtract=0, method=svdmethod)
+    scores, latent, comps = svd(data, k, meansubtract=0, method=svdmethod, checkpoint=checkpoint,
+                                warmstart=warmstart)
 
     return scores, latent, comps
 
@@ -31,6 +36,10 @@ if __name__ == "__main__":
     parser.add_argument("k", type=int)
     parser.add_argument("--svdmethod", choices=("direct", "em"), default="direct", required=False)
     parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
+    parser.add_argument("--checkpointdir", type=str, default=None, required=False)
+    parser.add_argument("--checkpointinterval", type=int, default=10, required=False)
+    parser.add_argument("--resume", action="store_true", default=False, required=False)
+    parser.add_argument("--warmstart", type=str, default=None, required=False)
 
     args = parser.parse_args()
 
@@ -42,7 +51,12 @@ if __name__ == "__main__":
 
     data = load(sc, args.datafile, args.preprocess).cache()
 
-    scores, latent, comps = pca(data, args.k, args.svdmethod)
+    if args.checkpointdir is not None:
+        checkpoint = Checkpoint(args.checkpointdir, args.checkpointinterval, args.resume)
+    else:
+        checkpoint = None
+
+    scores, latent, comps = pca(data, args.k, args.svdmethod, checkpoint, args.warmstart)
 
     outputdir = args.outputdir + "-pca"
 
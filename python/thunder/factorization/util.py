@@ -1,16 +1,82 @@
-from numpy import random, sum, real, argsort, mean, transpose, dot, inner, outer, zeros, shape, sqrt
-from scipy.linalg import eig, inv, orth
+from numpy import random, sum, mean, transpose, dot, inner, outer, zeros, shape, sqrt, diag, ix_, array, maximum, where
+from scipy.linalg import eigh, inv, orth
 from pyspark.accumulators import AccumulatorParam
+from thunder.util.matrixrdd import matrixstack_iterator
+from thunder.util.load import loadresult
 
 
-def svd(data, k, meansubtract=1, method="direct", maxiter=20, tol=0.00001):
+def eigtop(mat, k):
+    """Top k eigenvalues and eigenvectors of a symmetric matrix,
+    in descending order, computing only the requested subset
+
+    :param mat: symmetric array
+    :param k: number of eigenvalues and eigenvectors to return
+
+    :return w: the k largest eigenvalues
+    :return v: the corresponding eigenvectors (as columns)
+    """
+    d = shape(mat)[0]
+    w, v = eigh(mat, eigvals=(d - k, d - 1))
+    return w[::-1], v[:, ::-1]
+
+
+def gram(data, n):
+    """Compute the n x n gram matrix of inner products between records
+
+    Partitions are stacked into blocks, and the products between
+    every pair of blocks (upper triangle only) are computed in parallel
+
+    :param data: RDD of data points as key value pairs
+    :param n: number of records
+
+    :return g: the gram matrix (as array)
+    :return index: dictionary mapping each key to its row in the gram matrix
+    """
+    keys = data.map(lambda (k, _): k).collect()
+    index = dict(zip(keys, range(0, n)))
+
+    blocks = data.mapPartitions(matrixstack_iterator).mapPartitionsWithIndex(
+        lambda i, iterator: [(i, keys, x) for (keys, x) in iterator]).cache()
+    products = blocks.cartesian(blocks).filter(lambda (a, b): a[0] <= b[0]).map(
+        lambda (a, b): (a[1], b[1], dot(a[2], transpose(b[2])))).collect()
+    blocks.unpersist()
+
+    g = zeros((n, n))
+    for (k1, k2, prod) in products:
+        rows = [index[k] for k in k1]
+        cols = [index[k] for k in k2]
+        g[ix_(rows, cols)] = prod
+        g[ix_(cols, rows)] = transpose(prod)
+
+    return g, index
+
+
+def emstats(y, c_inv):
+    """Compute the statistics for one iteration of em for a block of records
+
+    :param y: array of records (one per row)
+    :param c_inv: pseudo inverse of the current subspace estimate
+
+    :return xx: sum of outer products of the projections, x'x
+    :return yx: sum of outer products of records and projections, y'x
+    """
+    x = dot(y, c_inv)
+    return dot(transpose(x), x), dot(transpose(y), x)
+
+
+def svd(data, k, meansubtract=1, method="direct", maxiter=20, tol=0.00001, history=False, checkpoint=None,
+        warmstart=None):
     """Large-scale singular value decomposition for dense matrices
 
-    Direct method uses an accumulator to distribute and sum outer products
-    only efficient when n >> m (tall and skinny)
-    requires that n ** 2 fits in memory
+    Direct method computes the m x m covariance by using an accumulator
+    to distribute and sum outer products, requires that m ** 2 fits in memory.
+    If the data are short and wide (k <= n and 2 n < m) it instead computes the
+    n x n gram matrix of records, requires that n ** 2 fits in memory
+    (closer to square, pairing up the blocks of records costs more than the accumulator).
+    Either way only the top k eigenvectors are computed locally
 
-    EM method uses an iterative algorithm based on expectation maximization
+    EM method uses an iterative algorithm based on expectation maximization,
+    each iteration makes a single pass through the data
 
     TODO: select method automatically based on data dimensions
     TODO: return fractional variance explained by k eigenvectors
@@ -19,13 +85,45 @@ def svd(data, k, meansubtract=1, method="direct", maxiter=20, tol=0.00001):
     :param k: number of components to recover
     :param method: choice of algorithm, "direct", "em" (default = "direct")
     :param meansubtract: whether or not to subtract the mean
+    :param maxiter: maximum number of iterations for em (default = 20)
+    :param tol: tolerance for change in estimate for em (default = 0.00001)
+    :param history: whether to also return the error at each em iteration (default = False)
+    :param checkpoint: Checkpoint for saving and resuming the state of em (default = None)
+    :param warmstart: initial subspace for em, as an array or the location of
+        comps saved by a previous run (default = None, for random)
 
     :return comps: the left k eigenvectors (as array)
     :return latent: the singular values
     :return scores: the right k eigenvectors (as RDD)
+    :return errvec: the error at each iteration (em only, if history is True)
     """
     if method == "direct":
 
+        n = data.count()
+        m = len(data.first()[1])
+        if meansubtract == 1:
+            data = data.mapValues(lambda x: x - mean(x))
+
+        if (2 * n < m) & (k <= n):
+
+            # do local eigendecomposition of the gram matrix,
+            # its eigenvectors are the scores
+            g, index = gram(data, n)
+            # eigenvalues beyond the rank of the records come out as numerical
+            # noise (possibly negative), zero them and their components
+            w, v = eigtop(g, k)
+            latent = sqrt(where(w > 1E-10 * w[0], w, 0))
+
+            # project back into data, normalize by singular values
+            u = data.context.broadcast((index, v))
+            comps = data.mapPartitions(matrixstack_iterator).map(
+                lambda (keys, x): dot(transpose(u.value[1][[u.value[0][key] for key in keys]]), x)).sum()
+            comps = dot(diag(where(latent > 0, 1 / where(latent > 0, latent, 1), 0)), comps)
+
+            scores = data.map(lambda (key, _): (key, u.value[1][u.value[0][key]]))
+
+            return scores, latent, comps
+
         # set up a matrix accumulator
         class MatrixAccumulatorParam(AccumulatorParam):
             def zero(self, value):
@@ -35,11 +133,6 @@ def svd(data, k, meansubtract=1, method="direct", maxiter=20, tol=0.00001):
                 val1 += val2
                 return val1
 
-        n = data.count()
-        m = len(data.first()[1])
-        if meansubtract == 1:
-            data = data.mapValues(lambda x: x - mean(x))
-
         # create a variable and method to compute sums of outer products
         global cov
         cov = data.context.accumulator(zeros((m, m)), MatrixAccumulatorParam())
@@ -52,12 +145,9 @@ def svd(data, k, meansubtract=1, method="direct", maxiter=20, tol=0.00001):
         data.map(lambda (_, v): v).foreach(outersum)
 
         # do local eigendecomposition
-        w, v = eig(cov.value / n)
-        w = real(w)
-        v = real(v)
-        inds = argsort(w)[::-1]
-        latent = sqrt(w[inds[0:k]]) * sqrt(n)
-        comps = transpose(v[:, inds[0:k]])
+        w, v = eigtop(cov.value / n, k)
+        latent = sqrt(w) * sqrt(n)
+        comps = transpose(v)
 
         # project back into data, normalize by singular values
         scores = data.mapValues(lambda x: inner(x, comps) / latent)
@@ -71,44 +161,108 @@ def svd(data, k, meansubtract=1, method="direct", maxiter=20, tol=0.00001):
         if meansubtract == 1:
             data = data.mapValues(lambda x: x - mean(x))
 
-        def outerprod(x):
-            return outer(x, x)
+        blocks = data.mapPartitions(matrixstack_iterator).map(lambda (_, y): y)
 
-        c = random.rand(k, m)
+        if warmstart is not None:
+            c = loadresult(warmstart, "comps")
+        else:
+            c = random.rand(k, m)
         iter = 0
         error = 100
+        errvec = []
+
+        if checkpoint is not None:
+            state = checkpoint.restore("svd-em")
+            if state is not None:
+                c, error, iter, errvec = state["c"], state["error"], state["iter"], state["errvec"]
 
         # iterative update subspace using expectation maximization
         # e-step: x = (c'c)^-1 c' y
         # m-step: c = y x' (xx')^-1
+        # both statistics are computed in one pass over blocks of records
         while (iter < maxiter) & (error > tol):
             c_old = c
             # pre compute (c'c)^-1 c'
             c_inv = dot(transpose(c), inv(dot(c, transpose(c))))
             premult1 = data.context.broadcast(c_inv)
-            # compute (xx')^-1 through a map reduce
-            xx = data.map(lambda (_, v): v).map(lambda x: outerprod(dot(x, premult1.value))).sum()
-            xx_inv = inv(xx)
-            # pre compute (c'c)^-1 c' (xx')^-1
-            premult2 = data.context.broadcast(dot(c_inv, xx_inv))
-            # compute the new c through a map reduce
-            c = data.map(lambda (_, v): v).map(lambda x: outer(x, dot(x, premult2.value))).sum()
-            c = transpose(c)
+            # compute xx' and yx' through a single map reduce
+            xx, yx = blocks.map(lambda y: emstats(y, premult1.value)).reduce(
+                lambda a, b: (a[0] + b[0], a[1] + b[1]))
+            premult1.unpersist()
+            # compute the new c
+            c = transpose(dot(yx, inv(xx)))
 
             error = sum(sum((c - c_old) ** 2))
+            errvec.append(error)
             iter += 1
 
+            if checkpoint is not None:
+                checkpoint.save("svd-em", iter, {"c": c, "error": error, "iter": iter, "errvec": errvec})
+
         # project data into subspace spanned by columns of c
         # use standard eigendecomposition to recover an orthonormal basis
         c = transpose(orth(transpose(c)))
-        premult3 = data.context.broadcast(c)
-        cov = data.map(lambda (_, v): v).map(lambda x: dot(x, transpose(premult3.value))).map(lambda x: outerprod(x)).mean()
-        w, v = eig(cov)
-        w = real(w)
-        v = real(v)
-        inds = argsort(w)[::-1]
-        latent = sqrt(w[inds[0:k]]) * sqrt(n)
-        comps = dot(transpose(v[:, inds[0:k]]), c)
+        premult2 = data.context.broadcast(c)
+        cov = blocks.map(lambda y: dot(y, transpose(premult2.value))).map(lambda x: dot(transpose(x), x)).sum() / n
+        premult2.unpersist()
+        w, v = eigtop(cov, k)
+        latent = sqrt(w) * sqrt(n)
+        comps = dot(transpose(v), c)
+        scores = data.mapValues(lambda x: inner(x, comps) / latent)
+
+        if history:
+            return scores, latent, comps, array(errvec)
+        else:
+            return scores, latent, comps
+
+
+class IncrementalSVD(object):
+    """Class for a singular value decomposition that is
+    updated incrementally as new batches of records arrive
+
+    Only the rank k estimate of the right singular vectors and
+    singular values is kept between batches, so memory use doesn't
+    grow with the number of records. Each update combines the current
+    estimate with the new records, by computing the top k eigenvectors
+    of comps' diag(latent ** 2) comps + y'y (requires that m ** 2 fits in memory)
+    """
+
+    def __init__(self, k):
+        """Create an empty decomposition
+
+        :param k: number of components to recover
+        """
+        self.k = k
+        self.n = 0
+        self.latent = None
+        self.comps = None
+
+    def update(self, data):
+        """Update the decomposition with a new batch of records
+
+        :param data: RDD of data points as key value pairs
+
+        :return scores: the right k eigenvectors for the new batch (as RDD)
+        :return latent: the singular values of all records so far
+        :return comps: the left k eigenvectors of all records so far (as array)
+        """
+        self.n += data.count()
+
+        # sum outer products of the new records
+        cov = data.mapPartitions(matrixstack_iterator).map(lambda (_, y): dot(transpose(y), y)).sum()
+
+        # add the rank k estimate from previous batches
+        if self.comps is not None:
+            cov += dot(transpose(self.comps), dot(diag(self.latent ** 2), self.comps))
+
+        # do local eigendecomposition
+        w, v = eigtop(cov, self.k)
+        latent = sqrt(maximum(w, 0))
+        comps = transpose(v)
+        self.latent = latent
+        self.comps = comps
+
+        # project the new records, normalize by singular values
         scores = data.mapValues(lambda x: inner(x, comps) / latent)
 
         return scores, latent, comps
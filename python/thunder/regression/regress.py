@@ -7,23 +7,24 @@ from thunder.util.save import save
 from pyspark import SparkContext
 
 
-def regress(data, modelfile, regressmode):
+def regress(data, modelfile, regressmode, *opts):
     """Perform mass univariate regression
 
     :param data: RDD of data points as key value pairs
     :param modelfile: model parameters (string with file location, array, or tuple)
-    :param regressmode: form of regression ("linear" or "bilinear")
+    :param regressmode: form of regression ("linear", "bilinear" or "ridge")
+    :param opts: additional model parameters (for "ridge", the list of lambdas and whether to use gcv)
 
     :return stats: statistics of the fit
     :return betas: regression coefficients
     """
     # create model
-    model = RegressionModel.load(modelfile, regressmode)
+    model = RegressionModel.load(modelfile, regressmode, *opts)
 
-    # do regression
-    betas, stats, resid = model.fit(data)
+    # do regression (not persisted, as the caller cannot release it)
+    result = model.fit(data, storagelevel=None)
 
-    return stats, betas
+    return result.stats, result.betas
 
 
 if __name__ == "__main__":
@@ -32,22 +33,40 @@ if __name__ == "__main__":
     parser.add_argument("datafile", type=str)
     parser.add_argument("modelfile", type=str)
     parser.add_argument("outputdir", type=str)
-    parser.add_argument("regressmode", choices=("linear", "bilinear"), help="form of regression")
+    parser.add_argument("regressmode", choices=("linear", "bilinear", "ridge"), help="form of regression")
+    parser.add_argument("--lambdas", type=float, nargs="+", default=[1.0], required=False)
+    parser.add_argument("--gcv", action="store_true", default=False, required=False)
+    parser.add_argument("--nperm", type=int, default=0, required=False)
     parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
 
     args = parser.parse_args()
 
+    if (args.nperm > 0) & (args.regressmode != "linear"):
+        parser.error("permutation tests (--nperm) are only available for linear regression")
+
     sc = SparkContext(args.master, "regress")
 
     if args.master != "local":
         egg = glob.glob(os.path.join(os.environ['THUNDER_EGG'], "*.egg"))
         sc.addPyFile(egg[0])
     
-    data = load(sc, args.datafile, args.preprocess)
+    data = load(sc, args.datafile, args.preprocess).cache()
+
+    if args.regressmode == "ridge":
+        opts = (args.lambdas, args.gcv)
+    else:
+        opts = ()
 
-    stats, betas = regress(data, args.modelfile, args.regressmode)
+    # fit once for both stats and betas, and release the fit after saving
+    model = RegressionModel.load(args.modelfile, args.regressmode, *opts)
+    result = model.fit(data)
 
     outputdir = args.outputdir + "-regress"
 
-    save(stats, outputdir, "stats", "matlab")
-    save(betas, outputdir, "betas", "matlab")
+    save(result.stats, outputdir, "stats", "matlab")
+    save(result.betas, outputdir, "betas", "matlab")
+    result.unpersist()
+
+    if args.nperm > 0:
+        pvals = model.permtest(data, args.nperm)
+        save(pvals, outputdir, "pvals", "matlab")
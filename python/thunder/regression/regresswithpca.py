@@ -26,16 +26,19 @@ def regresswithpca(data, modelfile, regressmode, k=2):
     # create model
     model = RegressionModel.load(modelfile, regressmode)
 
-    # do regression
-    betas, stats, resid = model.fit(data)
+    # do regression, keeping the statistics for trajectories
+    result = model.fit(data, traj=True)
 
     # do principal components analysis
-    scores, latent, comps = svd(betas, k)
+    scores, latent, comps = svd(result.betas, k)
 
-    # compute trajectories from raw data
-    traj = model.fit(data, comps)
+    # compute trajectories from the statistics kept with the fit
+    traj = result.trajectories(comps)
 
-    return stats, comps, latent, scores, traj
+    # release the fit, stats and scores are computed again when used
+    result.unpersist()
+
+    return result.stats, comps, latent, scores, traj
 
 
 if __name__ == "__main__":
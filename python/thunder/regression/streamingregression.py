@@ -0,0 +1,224 @@
+import os
+import argparse
+import glob
+import shutil
+import cPickle
+from base64 import b64encode, b64decode
+from numpy import array, sum, dot, transpose, concatenate, ones, shape, newaxis, where
+from scipy.linalg import inv
+from thunder.util.load import loadbatches
+from thunder.util.matrixrdd import matrixstack_iterator
+from thunder.util.save import save
+from thunder.util.checkpoint import Checkpoint
+from pyspark import SparkContext
+
+
+def regressionstats(y, x):
+    """Compute the sufficient statistics of a block of records (one per row) for a design
+
+    :param y: array of records (one per row)
+    :param x: design (regressors x time, including a row of ones)
+
+    :return stats: array with the count, sum, sum of squares and x y' of each record (one per row)
+    """
+    n = len(y)
+    return concatenate((shape(y)[1] * ones((n, 1)), sum(y, axis=1)[:, newaxis], sum(y ** 2, axis=1)[:, newaxis],
+                        dot(y, transpose(x))), axis=1)
+
+
+def regressionfit(stats, xx_inv):
+    """Compute regression coefficients and r2 statistics of a block
+    of records (one per row) from their sufficient statistics
+
+    :param stats: array with the count, sum, sum of squares and x y' of each record (one per row)
+    :param xx_inv: inverse of the accumulated x x'
+
+    :return betas: regression coefficients (including the intercept, one row per record)
+    :return r2: r2 statistic of each record
+    """
+    n, sy, syy, xy = stats[:, 0], stats[:, 1], stats[:, 2], stats[:, 3:]
+    b = dot(xy, xx_inv)
+    sse = syy - sum(b * xy, axis=1)
+    sst = syy - sy ** 2 / n
+    r2 = where(sst == 0, 0, 1 - sse / where(sst == 0, 1, sst))
+    return b, r2
+
+
+class StatefulLinearRegression(object):
+    """Class for linear regression on streaming data, with a running
+    fit for every record as new batches of data arrive
+
+    Every batch contains one record per key, along with a design
+    shared by all records (given with the batch, or by records with feature keys,
+    each giving one regressor). Batches can have different lengths.
+    The design's x x' is accumulated on the driver, and the count, sum,
+    sum of squares and x y' of every record are accumulated in a persisted RDD,
+    so each update only does work proportional to the new batch, and the betas
+    and r2 statistics of all the data so far follow from these statistics
+    """
+
+    def __init__(self, featurekeys=None):
+        """Create stateful regression
+
+        :param featurekeys: keys of the records used as regressors (default = None, for designs given with batches)
+        """
+        self.featurekeys = featurekeys
+        self.xx = None
+        self.state = None
+        self.result = None
+        self.statedir = None
+        self.nbatches = 0
+
+    def update(self, data, x=None, checkpoint=None):
+        """Update the running fits with a new batch of data
+
+        :param data: RDD of data points as key value pairs
+        :param x: design for the batch (regressors x time) (default = None, for the records with feature keys)
+        :param checkpoint: Checkpoint for truncating the lineage of the state at the end of
+            its interval, which otherwise grows with every batch (default = None)
+
+        :return betas: RDD with the regression coefficients of each record
+        :return stats: RDD with the r2 statistic of each record
+        """
+        if x is None:
+            featurekeys = self.featurekeys
+            features = dict(data.filter(lambda (k, _): k in featurekeys).collect())
+            x = array([features[k] for k in featurekeys])
+            data = data.filter(lambda (k, _): k not in featurekeys)
+        x = concatenate((ones((1, shape(x)[1])), x))
+
+        if self.xx is None:
+            self.xx = dot(x, transpose(x))
+        else:
+            self.xx = self.xx + dot(x, transpose(x))
+
+        batch = data.mapPartitions(matrixstack_iterator).flatMap(
+            lambda (keys, y): zip(keys, regressionstats(y, x)))
+        if self.state is None:
+            state = batch
+        else:
+            state = self.state.union(batch).reduceByKey(lambda a, b: a + b)
+        state.cache()
+        if checkpoint is not None:
+            if (self.nbatches + 1) % checkpoint.interval == 0:
+                checkpoint.truncate(state)
+        state.count()
+        if self.state is not None:
+            self.state.unpersist()
+        self.state = state
+        self.nbatches += 1
+
+        return self.get()
+
+    def get(self):
+        """Get the current fits, computed once into a persisted RDD
+        (released when the fits are next updated)
+
+        :return betas: RDD with the regression coefficients of each record
+        :return stats: RDD with the r2 statistic of each record
+        """
+        xx_inv = inv(self.xx)
+        if self.result is not None:
+            self.result.unpersist()
+        self.result = self.state.mapPartitions(matrixstack_iterator).flatMap(
+            lambda (keys, stats): zip(keys, zip(*regressionfit(stats, xx_inv)))).cache()
+        betas = self.result.mapValues(lambda x: x[0][1:])
+        stats = self.result.mapValues(lambda x: x[1])
+        return betas, stats
+
+    def save(self, checkpoint):
+        """Save the state to a checkpoint (if at the end of its interval)
+
+        The statistics of every record are written by the workers to a directory
+        under the checkpoint path (one pickled record per line), and only x x',
+        the number of batches and that directory are saved from the driver.
+        The directory of the previous saved state is then removed
+
+        :param checkpoint: Checkpoint
+        """
+        if self.nbatches % checkpoint.interval == 0:
+            statedir = os.path.join(checkpoint.path, "streamingregression-state-%d" % self.nbatches)
+            # left over if a previous run failed before saving the driver state
+            shutil.rmtree(statedir, ignore_errors=True)
+            self.state.map(lambda x: b64encode(cPickle.dumps(x, cPickle.HIGHEST_PROTOCOL))).saveAsTextFile(statedir)
+            checkpoint.save("streamingregression", self.nbatches,
+                            {"xx": self.xx, "nbatches": self.nbatches, "statedir": statedir})
+            if self.statedir is not None:
+                if self.statedir != statedir:
+                    shutil.rmtree(self.statedir, ignore_errors=True)
+            self.statedir = statedir
+
+    def restore(self, sc, checkpoint):
+        """Restore the state from a checkpoint (if resuming and one was saved)
+
+        :param sc: SparkContext
+        :param checkpoint: Checkpoint
+        """
+        state = checkpoint.restore("streamingregression")
+        if state is not None:
+            self.xx = state["xx"]
+            self.nbatches = state["nbatches"]
+            self.statedir = state["statedir"]
+            self.state = sc.textFile(state["statedir"]).map(lambda x: cPickle.loads(b64decode(x))).cache()
+
+
+def streamingregression(batches, featurekeys, checkpoint=None, outputdir=None):
+    """Perform mass univariate linear regression on data as they arrive,
+    updating the fits with each new batch of data
+
+    :param batches: iterable of RDDs of data points as key value pairs
+    :param featurekeys: keys of the records used as regressors
+    :param checkpoint: Checkpoint for saving and resuming the state between batches (default = None)
+    :param outputdir: location to save betas and stats after each batch (default = None, for no saving)
+
+    :return betas: RDD with the regression coefficients of each record
+    :return stats: RDD with the r2 statistic of each record
+    """
+    model = StatefulLinearRegression(featurekeys)
+    betas, stats = None, None
+
+    for data in batches:
+        if (checkpoint is not None) & (model.state is None):
+            model.restore(data.context, checkpoint)
+        betas, stats = model.update(data, checkpoint=checkpoint)
+        if checkpoint is not None:
+            model.save(checkpoint)
+        if outputdir is not None:
+            save(betas, outputdir, "betas", "matlab")
+            save(stats, outputdir, "stats", "matlab")
+
+    return betas, stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fit a regression model to data as they arrive")
+    parser.add_argument("master", type=str)
+    parser.add_argument("datadir", type=str)
+    parser.add_argument("outputdir", type=str)
+    parser.add_argument("featurekeys", type=str, nargs="+", help="keys of the regressors, e.g. 1,1,1")
+    parser.add_argument("--interval", type=float, default=1.0, required=False)
+    parser.add_argument("--timeout", type=float, default=None, required=False)
+    parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
+    parser.add_argument("--checkpointdir", type=str, default=None, required=False)
+    parser.add_argument("--checkpointinterval", type=int, default=1, required=False)
+    parser.add_argument("--resume", action="store_true", default=False, required=False)
+
+    args = parser.parse_args()
+
+    sc = SparkContext(args.master, "streamingregression")
+
+    if args.master != "local":
+        egg = glob.glob(os.path.join(os.environ['THUNDER_EGG'], "*.egg"))
+        sc.addPyFile(egg[0])
+
+    featurekeys = [tuple(int(x) for x in key.split(",")) for key in args.featurekeys]
+
+    batches = loadbatches(sc, args.datadir, args.preprocess, interval=args.interval, timeout=args.timeout)
+
+    if args.checkpointdir is not None:
+        checkpoint = Checkpoint(args.checkpointdir, args.checkpointinterval, args.resume)
+    else:
+        checkpoint = None
+
+    outputdir = args.outputdir + "-streamingregression"
+
+    betas, stats = streamingregression(batches, featurekeys, checkpoint, outputdir)
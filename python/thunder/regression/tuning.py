@@ -26,8 +26,8 @@ def tuning(data, tuningmodelfile, tuningmode, regressmodelfile=None, regressmode
     if regressmodelfile is not None:
         # use regression results
         regressmodel = RegressionModel.load(regressmodelfile, regressmode)
-        betas, stats, resid = regressmodel.fit(data)
-        params = tuningmodel.fit(betas)
+        # the betas are only used once, so the fit is not persisted
+        params = tuningmodel.fit(regressmodel.fit(data, storagelevel=None).betas)
     else:
         # use data
         params = tuningmodel.fit(data)
@@ -40,7 +40,8 @@ if __name__ == "__main__":
     parser.add_argument("datafile", type=str)
     parser.add_argument("tuningmodelfile", type=str)
     parser.add_argument("outputdir", type=str)
-    parser.add_argument("tuningmode", choices=("circular", "gaussian"), help="form of tuning curve")
+    parser.add_argument("tuningmode", choices=("circular", "gaussian", "circular-ls", "gaussian-ls"),
+                        help="form of tuning curve")
     parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
     parser.add_argument("--regressmodelfile", type=str)
     parser.add_argument("--regressmode", choices=("linear", "bilinear"), help="form of regression")
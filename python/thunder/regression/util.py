@@ -3,8 +3,83 @@ Utilities for regression and tuning curve fitting
 """
 
 from scipy.io import loadmat
-from numpy import array, sum, outer, inner, mean, shape, dot, transpose, concatenate, ones, angle, abs, exp
-from scipy.linalg import inv
+from numpy import array, sum, mean, shape, dot, transpose, concatenate, ones, angle, abs, exp, \
+    newaxis, where, einsum, argmin, argmax, arange, log, maximum, ravel, cos, sin
+from numpy.linalg import solve, svd
+from scipy.linalg import inv, orth
+from pyspark import StorageLevel
+from thunder.util.matrixrdd import matrixstack_iterator
+from thunder.util.permutation import permutations, permtest
+
+
+def trajectorystats(y, b):
+    """Return the sum over a block of records of the outer product of each
+    record with its (mean subtracted) betas, computed as y' (b - mean(b)),
+    trajectories for any components then follow by a product with comps'"""
+
+    return dot(transpose(y), b - mean(b, axis=1)[:, newaxis])
+
+
+class FitResult(object):
+    """Class for the result of fitting a regression model to every record
+
+    The fit is computed once (when first used) into a persisted RDD
+    with the keys, betas, stats and resid of each block of records, and
+    betas, stats and resid are lazy projections of it. Unpacking gives
+    betas, stats, resid. Residuals are only kept if requested, otherwise
+    resid fits the data again when it is used. If requested, each block
+    also keeps the statistics for trajectories, so they need no further
+    pass through the data. The result stays persisted until unpersist is
+    called; if only one projection will be used once, it need not be
+    persisted at all (storagelevel = None)
+    """
+
+    def __init__(self, model, data, resid=False, storagelevel="MEMORY_ONLY", traj=False):
+        """Fit model
+
+        :param model: RegressionModel
+        :param data: RDD of data points as key value pairs
+        :param resid: whether to keep the residuals (default = False)
+        :param storagelevel: Spark storage level for the result (default = "MEMORY_ONLY", None for not persisting)
+        :param traj: whether to keep the statistics for trajectories (default = False)
+        """
+        def fitblock(keys, y):
+            betas, stats, residuals = model.getblock(y, resid)
+            betas = array(betas)
+            return keys, betas, stats, residuals, trajectorystats(y, betas) if traj else None
+
+        self.result = data.mapPartitions(matrixstack_iterator).map(lambda (keys, y): fitblock(keys, y))
+        if storagelevel is not None:
+            self.result.persist(getattr(StorageLevel, storagelevel))
+        self.traj = traj
+        self.betas = self.result.flatMap(lambda x: zip(x[0], x[1]))
+        self.stats = self.result.flatMap(lambda x: zip(x[0], x[2]))
+        if resid:
+            self.resid = self.result.flatMap(lambda x: zip(x[0], x[3]))
+        else:
+            self.resid = data.mapPartitions(matrixstack_iterator).flatMap(
+                lambda (keys, y): zip(keys, model.getblock(y)[2]))
+
+    def trajectories(self, comps):
+        """Compute the average over records of the outer product of each
+        record with the projection of its (mean subtracted) betas onto comps
+
+        The sums of y' (b - mean(b)) kept with each block of the fit and the
+        counts are added up, and projected onto comps on the driver
+
+        :param comps: array of components (one per row)
+        :return traj: array of trajectories (one column per component)
+        """
+        if not self.traj:
+            raise Exception("trajectories require fitting with traj = True")
+        yb, n = self.result.map(lambda x: (x[4], len(x[0]))).reduce(lambda x, y: (x[0] + y[0], x[1] + y[1]))
+        return dot(yb, transpose(comps)) / n
+
+    def __iter__(self):
+        return iter((self.betas, self.stats, self.resid))
+
+    def unpersist(self):
+        self.result.unpersist()
 
 
 class RegressionModel(object):
@@ -17,18 +92,34 @@ class RegressionModel(object):
     def get(self, y):
         pass
 
-    def fit(self, data, comps=None):
+    def getblock(self, y, resid=True):
+        """Fit a block of records (one per row), by default one record at a time
+
+        :param y: array of records (one per row)
+        :param resid: whether to return residuals (default = True)
+
+        :return betas, stats, resid: sequences with one entry per record (resid entries are None if not returned)
+        """
+        betas, stats, residuals = zip(*[self.get(x) for x in y])
+        if not resid:
+            residuals = [None] * len(y)
+        return betas, stats, residuals
+
+    def fit(self, data, comps=None, resid=False, storagelevel="MEMORY_ONLY", traj=False):
+        """Fit the model to every record
+
+        :param data: RDD of data points as key value pairs
+        :param comps: components to compute trajectories for instead (default = None)
+        :param resid: whether to keep the residuals (default = False)
+        :param storagelevel: Spark storage level for the result (default = "MEMORY_ONLY", None for not persisting)
+        :param traj: whether to keep the statistics for trajectories (default = False)
+
+        :return result: FitResult with betas, stats and resid, or the trajectories if comps are given
+        """
         if comps is not None:
-            traj = data.map(lambda (_, v): v).map(
-                lambda x: outer(x, inner(self.get(x)[0] - mean(self.get(x)[0]), comps))).reduce(
-                    lambda x, y: x + y) / data.count()
-            return traj
+            return FitResult(self, data, False, None, True).trajectories(comps)
         else:
-            result = data.mapValues(lambda x: self.get(x))
-            betas = result.mapValues(lambda x: x[0])
-            stats = result.mapValues(lambda x: x[1])
-            resid = result.mapValues(lambda x: x[2])
-            return betas, stats, resid
+            return FitResult(self, data, resid, storagelevel, traj)
 
 
 class LinearRegressionModel(RegressionModel):
@@ -45,8 +136,10 @@ class LinearRegressionModel(RegressionModel):
         else:
             x = modelfile
         x = concatenate((ones((1, shape(x)[1])), x))
-        x_hat = dot(inv(dot(x, transpose(x))), x)
+        xx = dot(x, transpose(x))
+        x_hat = dot(inv(xx), x)
         self.x = x
+        self.xx = xx
         self.x_hat = x_hat
 
     def get(self, y):
@@ -63,6 +156,198 @@ class LinearRegressionModel(RegressionModel):
             r2 = 1 - sse / sst
         return b[1:], r2, resid
 
+    def getblock(self, y, resid=True):
+        """Compute regression coefficients, r2 statistics, and residuals
+        for a block of records (one per row) with a few matrix products
+
+        Without residuals the sum of squared errors is computed
+        from the betas as |y|^2 - b x x' b', without predictions
+        """
+        b = dot(y, transpose(self.x_hat))
+        if resid:
+            residuals = y - dot(b, self.x)
+            sse = sum(residuals ** 2, axis=1)
+        else:
+            residuals = [None] * len(y)
+            sse = sum(y ** 2, axis=1) - sum(dot(b, self.xx) * b, axis=1)
+        sst = sum((y - mean(y, axis=1)[:, newaxis]) ** 2, axis=1)
+        r2 = where(sst == 0, 0, 1 - sse / where(sst == 0, 1, sst))
+        return b[:, 1:], r2, residuals
+
+    def permtest(self, data, nperm=1000, seed=0, null=False, chunksize=1000):
+        """Test the r2 statistic of every record against a null distribution
+        from fits to the design with its time points randomly permuted
+
+        An orthonormal basis of the (centered) regressors is computed once, and
+        permuting its rows gives a basis for each permuted design, so the bases
+        of the design and all permutations are stacked into a single operator
+        and every r2 for a block of records comes from one product (the operator is broadcast)
+
+        :param data: RDD of data points as key value pairs
+        :param nperm: number of permutations (default = 1000)
+        :param seed: seed for the random permutations (default = 0, for no seed)
+        :param null: whether to also return the null distributions (default = False)
+        :param chunksize: number of records tested at once (default = 1000)
+
+        :return pvals: RDD with the p-value of the r2 of each record
+        :return nulls: RDD with the r2 of each record for every permutation (only if null is True)
+        """
+        x = self.x[1:]
+        basis = orth(transpose(x - mean(x, axis=1)[:, newaxis]))
+        perms = permutations(shape(x)[1], nperm, seed)
+        stacked = concatenate([basis] + [basis[perm] for perm in perms], axis=1)
+        r = shape(basis)[1]
+
+        def stats(y, stacked):
+            y = y - mean(y, axis=1)[:, newaxis]
+            sst = sum(y ** 2, axis=1)
+            ssr = sum((dot(y, stacked) ** 2).reshape(len(y), nperm + 1, r), axis=2)
+            r2 = where(sst[:, newaxis] == 0, 0, ssr / where(sst == 0, 1, sst)[:, newaxis])
+            return r2[:, 0], r2[:, 1:]
+
+        return permtest(data, stats, stacked, null, chunksize)
+
+
+class MultiRegressionModel(RegressionModel):
+    """Class for linear regression with several alternative designs"""
+
+    def __init__(self, modelfile):
+        """Load models
+
+        The projection matrices of all designs are concatenated, so
+        that the betas of every model come from one product with the data
+
+        :param modelfile: A dictionary of designs, each an array or a string
+        (assumes a MAT file with name modelfile_X containing variable X)
+        """
+        self.names = sorted(modelfile.keys())
+        self.models = [LinearRegressionModel(modelfile[name]) for name in self.names]
+        self.sizes = [shape(model.x)[0] for model in self.models]
+        self.x_hat = concatenate([model.x_hat for model in self.models])
+
+    def get(self, y):
+        """Compute regression coefficients, r2 statistics, and residuals for every model"""
+
+        b, r2, resid = self.getblock(y[newaxis, :])
+        return b[0], r2[0], resid[0]
+
+    def getblock(self, y, resid=True):
+        """Compute regression coefficients, r2 statistics, and residuals
+        for every model for a block of records (one per row)
+
+        Betas (without intercepts), r2 and residuals for each record
+        are concatenated over models (in order of name)
+        """
+        b = dot(y, transpose(self.x_hat))
+        sst = sum((y - mean(y, axis=1)[:, newaxis]) ** 2, axis=1)
+        ssy = sum(y ** 2, axis=1)
+        betas = []
+        r2 = []
+        residuals = []
+        start = 0
+        for (model, size) in zip(self.models, self.sizes):
+            bm = b[:, start:start + size]
+            if resid:
+                residuals.append(y - dot(bm, model.x))
+                sse = sum(residuals[-1] ** 2, axis=1)
+            else:
+                sse = ssy - sum(dot(bm, model.xx) * bm, axis=1)
+            betas.append(bm[:, 1:])
+            r2.append(where(sst == 0, 0, 1 - sse / where(sst == 0, 1, sst)))
+            start += size
+        if resid:
+            residuals = concatenate(residuals, axis=1)
+        else:
+            residuals = [None] * len(y)
+        return concatenate(betas, axis=1), transpose(array(r2)), residuals
+
+    def compare(self, stats, criterion="adjr2"):
+        """Find the best model for each record
+
+        :param stats: RDD with the r2 statistics of every model for each record (as given by fit)
+        :param criterion: "r2", "adjr2" (adjusted r2) or "bic" (default = "adjr2")
+
+        :return best: RDD with the index of the best model (in order of name) for each record
+        """
+        t = shape(self.models[0].x)[1]
+        p = array(self.sizes) - 1
+        if criterion == "r2":
+            return stats.mapValues(lambda r2: argmax(r2))
+        if criterion == "adjr2":
+            return stats.mapValues(lambda r2: argmax(1 - (1 - r2) * (t - 1.0) / (t - p - 1)))
+        if criterion == "bic":
+            return stats.mapValues(lambda r2: argmin(t * log(maximum(1 - r2, 1E-12)) + (p + 1) * log(t)))
+        raise Exception("criterion must be r2, adjr2 or bic")
+
+
+class RidgeRegressionModel(RegressionModel):
+    """Class for ridge regression with several regularization strengths"""
+
+    def __init__(self, modelfile, lambdas, gcv=False):
+        """Load model
+
+        The regressors are centered (so the intercept is not penalized),
+        and their singular value decomposition, computed once here, gives the
+        fits for every lambda from the same projection of the data
+
+        :param modelfile: An array, or a string (assumes a MAT file
+        with name modelfile_X containing variable X)
+        :param lambdas: list of regularization strengths
+        :param gcv: whether to select the lambda for each record by generalized cross validation (default = False)
+        """
+        if type(modelfile) is str:
+            x = loadmat(modelfile + "_X.mat")['X']
+        else:
+            x = modelfile
+        x = x - mean(x, axis=1)[:, newaxis]
+        u, s, v = svd(transpose(x), full_matrices=False)
+        lambdas = array(lambdas, dtype=float)
+        self.x = x
+        self.u = u
+        self.v = transpose(v)
+        self.lambdas = lambdas
+        self.gcv = gcv
+        # shrinkage of each singular direction, one row per lambda
+        self.shrink = s / (s ** 2 + lambdas[:, newaxis])
+        self.fraction = s ** 2 / (s ** 2 + lambdas[:, newaxis])
+
+    def get(self, y):
+        """Compute regression coefficients, r2 statistic, and residuals"""
+
+        b, r2, resid = self.getblock(y[newaxis, :])
+        return b[0], r2[0], resid[0]
+
+    def getblock(self, y, resid=True):
+        """Compute regression coefficients, r2 statistics, and residuals
+        for every lambda for a block of records (one per row)
+
+        Without gcv, betas, r2 and residuals for each record are concatenated
+        over lambdas (in order). With gcv, they are given for the lambda with the
+        lowest generalized cross validation error, and stats are r2 and that lambda
+        """
+        n, t = shape(y)
+        nl = len(self.lambdas)
+        y = y - mean(y, axis=1)[:, newaxis]
+        z = dot(y, self.u)
+        sst = sum(y ** 2, axis=1)
+        sse = sst[:, newaxis] - dot(z ** 2, transpose(2 * self.fraction - self.fraction ** 2))
+        r2 = where(sst[:, newaxis] == 0, 0, 1 - sse / where(sst == 0, 1, sst)[:, newaxis])
+        if self.gcv:
+            df = sum(self.fraction, axis=1) + 1
+            best = argmin(sse / (t - df) ** 2, axis=1)
+            b = dot(z * self.shrink[best], transpose(self.v))
+            stats = concatenate((r2[arange(n), best][:, newaxis], self.lambdas[best][:, newaxis]), axis=1)
+            if resid:
+                residuals = y - dot(z * self.fraction[best], transpose(self.u))
+        else:
+            b = einsum('ij,lj,kj->ilk', z, self.shrink, self.v).reshape(n, nl * shape(self.v)[0])
+            stats = r2
+            if resid:
+                residuals = (y[:, newaxis, :] - einsum('ij,lj,kj->ilk', z, self.fraction, self.u)).reshape(n, nl * t)
+        if not resid:
+            residuals = [None] * n
+        return b, stats, residuals
+
 
 class BilinearRegressionModel(RegressionModel):
     """Class for bilinear regression"""
@@ -83,6 +368,8 @@ class BilinearRegressionModel(RegressionModel):
         self.x1 = x1
         self.x2 = x2
         self.x1_hat = x1_hat
+        # products of every pair of rows of x2 (time x regressors ** 2)
+        self.x2x2 = einsum('jk,lk->kjl', x2, x2).reshape(shape(x2)[1], shape(x2)[0] ** 2)
 
     def get(self, y):
         """Compute two sets of regression coefficients, r2 statistic, and residuals"""
@@ -107,6 +394,37 @@ class BilinearRegressionModel(RegressionModel):
 
         return b2[1:], r2, resid
 
+    def getblock(self, y, resid=True):
+        """Compute two sets of regression coefficients, r2 statistics, and residuals
+        for a block of records (one per row)
+
+        The record specific designs x3 (a row of ones and x2 scaled by b1_hat)
+        are never built, their normal equations x3 x3' and x3 y come from products
+        of b1_hat ** 2, b1_hat and b1_hat * y with the fixed products of the rows of x2,
+        and all of them are solved together with a stacked solve
+        """
+        n, t = shape(y)
+        q = shape(self.x2)[0]
+        b1 = dot(y, transpose(self.x1_hat))
+        b1 = b1 - b1.min(axis=1)[:, newaxis]
+        b1_hat = dot(b1, self.x1)
+        b1_hat[sum(b1_hat, axis=1) == 0] += 1E-06
+        xb = dot(b1_hat, transpose(self.x2))
+        xx = concatenate((concatenate((t * ones((n, 1, 1)), xb[:, newaxis, :]), axis=2),
+                          concatenate((xb[:, :, newaxis], dot(b1_hat ** 2, self.x2x2).reshape(n, q, q)), axis=2)),
+                         axis=1)
+        x3y = concatenate((sum(y, axis=1)[:, newaxis], dot(b1_hat * y, transpose(self.x2))), axis=1)
+        b2 = solve(xx, x3y[:, :, newaxis])[:, :, 0]
+        if resid:
+            residuals = y - b2[:, 0:1] - b1_hat * dot(b2[:, 1:], self.x2)
+            sse = sum(residuals ** 2, axis=1)
+        else:
+            residuals = [None] * len(y)
+            sse = sum(y ** 2, axis=1) - sum(b2 * x3y, axis=1)
+        sst = sum((y - mean(y, axis=1)[:, newaxis]) ** 2, axis=1)
+        r2 = where(sst == 0, 0, 1 - sse / where(sst == 0, 1, sst))
+        return b2[:, 1:], r2, residuals
+
 
 class TuningModel(object):
     """Class for loading and fitting a tuning model"""
@@ -127,64 +445,199 @@ class TuningModel(object):
         return TUNING_MODELS[tuningmode](modelfile)
 
     def get(self, y):
+        """Estimate the tuning parameters of one record"""
+
+        return self.getblock(y[newaxis, :])[0]
+
+    def getblock(self, y):
         pass
 
     def fit(self, data):
-        return data.mapValues(lambda x: self.get(x))
+        return data.mapPartitions(matrixstack_iterator).flatMap(lambda (keys, y): zip(keys, self.getblock(y)))
 
 
 class CircularTuningModel(TuningModel):
     """Class for circular tuning"""
 
-    def get(self, y):
+    def getblock(self, y):
         """Estimates the circular mean and variance ("kappa")
         identical to the max likelihood estimates of the
-        parameters of the best fitting von-mises function
+        parameters of the best fitting von-mises function,
+        for a block of records (one per row)
+
+        :return params: array with the mean and kappa of each record (one row per record)
         """
-        y = y - min(y)
-        if sum(y) == 0:
-            y += 1E-06
-        y = y / sum(y)
-        r = inner(y, exp(1j * self.s))
+        y = y - y.min(axis=1)[:, newaxis]
+        y = where(sum(y, axis=1)[:, newaxis] == 0, y + 1E-06, y)
+        y = y / sum(y, axis=1)[:, newaxis]
+        r = dot(y, exp(1j * ravel(self.s)))
         mu = angle(r)
-        v = abs(r) / sum(y)
-        if v < 0.53:
-            k = 2 * v + (v ** 3) + 5 * (v ** 5) / 6
-        elif (v >= 0.53) & (v < 0.85):
-            k = -.4 + 1.39 * v + 0.43 / (1 - v)
-        elif (v ** 3 - 4 * (v ** 2) + 3 * v) == 0:
-            k = array([0.0])
-        else:
-            k = 1 / (v ** 3 - 4 * (v ** 2) + 3 * v)
-        if k > 1E8:
-            k = array([0.0])
-        return mu, k
+        v = abs(r) / sum(y, axis=1)
+        cubic = v ** 3 - 4 * (v ** 2) + 3 * v
+        k = where(v < 0.53, 2 * v + (v ** 3) + 5 * (v ** 5) / 6,
+                  where(v < 0.85, -.4 + 1.39 * v + 0.43 / (1 - where(v < 0.85, v, 0)),
+                        where(cubic == 0, 0, 1 / where(cubic == 0, 1, cubic))))
+        k = where(k > 1E8, 0, k)
+        return transpose(array([mu, k]))
 
 
 class GaussianTuningModel(TuningModel):
     """Class for gaussian tuning"""
 
-    def get(self, y):
+    def getblock(self, y):
         """Estimates the mean and variance
         similar to the max likelihood estimates of the
         parameters of the best fitting gaussian
-        but non-infinite supports may bias estimates
+        but non-infinite supports may bias estimates,
+        for a block of records (one per row)
+
+        :return params: array with the mean and variance of each record (one row per record)
+        """
+        s = ravel(self.s)
+        y = maximum(y, 0)
+        y = where(sum(y, axis=1)[:, newaxis] == 0, y + 1E-06, y)
+        y = y / sum(y, axis=1)[:, newaxis]
+        mu = dot(y, s)
+        sigma = sum(y * (s - mu[:, newaxis]) ** 2, axis=1)
+        return transpose(array([mu, sigma]))
+
+
+def levenbergmarquardt(y, params, func, maxiter=20, tol=1E-06):
+    """Fit a nonlinear model to every record in a block (one per row)
+    by least squares, with Levenberg-Marquardt iterations vectorized over records
+
+    Each iteration solves the damped normal equations of all the records still
+    being fit with one stacked solve, and keeps each step only if it lowers
+    that record's error (then the damping decreases, otherwise it increases).
+    Records stop once a step lowers their error by less than a fraction tol
+
+    :param y: array of records (one per row)
+    :param params: array of initial parameters (one row per record)
+    :param func: function of records' parameters returning their predictions and
+        jacobians (records x time x parameters), and the parameters made valid
+    :param maxiter: number of iterations (default = 20)
+    :param tol: relative change in error for stopping (default = 1E-06)
+
+    :return params: array of fitted parameters (one row per record)
+    """
+    f, _, params = func(array(params, dtype=float))
+    cost = sum((y - f) ** 2, axis=1)
+    damping = 0.001 * ones(len(y))
+    active = arange(len(y))
+
+    for i in range(0, maxiter):
+        if len(active) == 0:
+            break
+        f, jac, _ = func(params[active])
+        r = y[active] - f
+        jj = einsum('itj,itk->ijk', jac, jac)
+        d = arange(shape(jj)[1])
+        jj[:, d, d] += damping[active, newaxis] * (jj[:, d, d] + 1E-09)
+        step = solve(jj, einsum('itj,it->ij', jac, r)[:, :, newaxis])[:, :, 0]
+        f, _, candidate = func(params[active] + step)
+        newcost = sum((y[active] - f) ** 2, axis=1)
+        better = newcost < cost[active]
+        done = better & (cost[active] - newcost <= tol * cost[active])
+        params[active[better]] = candidate[better]
+        cost[active[better]] = newcost[better]
+        damping[active] = where(better, damping[active] / 10, damping[active] * 10)
+        active = active[~done & (damping[active] < 1E10)]
+
+    return params
+
+
+class CircularLeastSquaresTuningModel(CircularTuningModel):
+    """Class for circular tuning fit by least squares"""
+
+    def __init__(self, modelfile, maxiter=20, tol=1E-06):
+        """Load model
+
+        :param modelfile: An array, or a string (assumes a MAT file
+        with name modelfile_s containing variable s)
+        :param maxiter: number of iterations (default = 20)
+        :param tol: relative change in error for stopping (default = 1E-06)
+        """
+        super(CircularLeastSquaresTuningModel, self).__init__(modelfile)
+        self.maxiter = maxiter
+        self.tol = tol
+
+    def vonmises(self, params):
+        """Predictions a + b exp(k (cos(s - mu) - 1)) and their jacobians
+        for parameters (mu, k, a, b), one row per record"""
+
+        s = ravel(self.s)
+        params = params.copy()
+        params[:, 1] = maximum(params[:, 1], 0)
+        mu, k, a, b = [params[:, i][:, newaxis] for i in range(0, 4)]
+        c = cos(s - mu) - 1
+        e = exp(k * c)
+        jac = array([b * e * k * sin(s - mu), b * e * c, ones(shape(e)), e]).transpose(1, 2, 0)
+        return a + b * e, jac, params
+
+    def getblock(self, y):
+        """Fits a von mises function a + b exp(k (cos(s - mu) - 1)) to each record
+        in a block by least squares, starting from the circular mean and kappa
+
+        :return params: array with the mean, kappa, baseline and amplitude of each record (one row per record)
+        """
+        init = super(CircularLeastSquaresTuningModel, self).getblock(y)
+        a = y.min(axis=1)
+        params = concatenate((init, transpose(array([a, y.max(axis=1) - a]))), axis=1)
+        params = levenbergmarquardt(y, params, self.vonmises, self.maxiter, self.tol)
+        params[:, 0] = angle(exp(1j * params[:, 0]))
+        return params
+
+
+class GaussianLeastSquaresTuningModel(GaussianTuningModel):
+    """Class for gaussian tuning fit by least squares"""
+
+    def __init__(self, modelfile, maxiter=20, tol=1E-06):
+        """Load model
+
+        :param modelfile: An array, or a string (assumes a MAT file
+        with name modelfile_s containing variable s)
+        :param maxiter: number of iterations (default = 20)
+        :param tol: relative change in error for stopping (default = 1E-06)
+        """
+        super(GaussianLeastSquaresTuningModel, self).__init__(modelfile)
+        self.maxiter = maxiter
+        self.tol = tol
+
+    def gaussian(self, params):
+        """Predictions a + b exp(-(s - mu)^2 / (2 v)) and their jacobians
+        for parameters (mu, v, a, b), one row per record"""
+
+        s = ravel(self.s)
+        params = params.copy()
+        params[:, 1] = maximum(params[:, 1], 1E-09)
+        mu, v, a, b = [params[:, i][:, newaxis] for i in range(0, 4)]
+        d = s - mu
+        e = exp(-d ** 2 / (2 * v))
+        jac = array([b * e * d / v, b * e * d ** 2 / (2 * v ** 2), ones(shape(e)), e]).transpose(1, 2, 0)
+        return a + b * e, jac, params
+
+    def getblock(self, y):
+        """Fits a gaussian function a + b exp(-(s - mu)^2 / (2 v)) to each record
+        in a block by least squares, starting from the mean and variance above the baseline
+
+        :return params: array with the mean, variance, baseline and amplitude of each record (one row per record)
         """
-        y[y < 0] = 0
-        if sum(y) == 0:
-            y += 1E-06
-        y = y / sum(y)
-        mu = dot(self.s, y)
-        sigma = dot((self.s - mu) ** 2, y)
-        return mu, sigma
+        a = y.min(axis=1)
+        init = super(GaussianLeastSquaresTuningModel, self).getblock(y - a[:, newaxis])
+        params = concatenate((init, transpose(array([a, y.max(axis=1) - a]))), axis=1)
+        return levenbergmarquardt(y, params, self.gaussian, self.maxiter, self.tol)
 
 
 TUNING_MODELS = {
     'circular': CircularTuningModel,
-    'gaussian': GaussianTuningModel
+    'gaussian': GaussianTuningModel,
+    'circular-ls': CircularLeastSquaresTuningModel,
+    'gaussian-ls': GaussianLeastSquaresTuningModel
 }
 
 REGRESSION_MODELS = {
     'linear': LinearRegressionModel,
-    'bilinear': BilinearRegressionModel
+    'bilinear': BilinearRegressionModel,
+    'ridge': RidgeRegressionModel,
+    'multi': MultiRegressionModel
 }
\ No newline at end of file
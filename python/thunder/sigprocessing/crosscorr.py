@@ -42,6 +42,7 @@ if __name__ == "__main__":
     parser.add_argument("sigfile", type=str)
     parser.add_argument("outputdir", type=str)
     parser.add_argument("lag", type=int)
+    parser.add_argument("--nperm", type=int, default=0, required=False)
     parser.add_argument("--preprocess", choices=("raw", "dff", "dff-highpass", "sub"), default="raw", required=False)
 
     args = parser.parse_args()
@@ -65,3 +66,7 @@ if __name__ == "__main__":
     else:
         betas = crosscorr(data, args.sigfile, args.lag)
         save(betas, outputdir, "stats", "matlab")
+
+    if args.nperm > 0:
+        method = SigProcessingMethod.load("crosscorr", sigfile=args.sigfile, lag=args.lag)
+        save(method.permtest(data, args.nperm), outputdir, "pvals", "matlab")
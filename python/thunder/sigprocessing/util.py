@@ -2,10 +2,12 @@
 utilities for signal processing
 """
 
-from numpy import sqrt, fix, pi, median, std, sum, mean, shape, zeros, roll, dot, angle, abs
+from numpy import sqrt, fix, pi, median, std, sum, mean, shape, zeros, roll, dot, angle, abs, concatenate, \
+    newaxis, where, transpose, atleast_2d
 from scipy.linalg import norm
 from scipy.io import loadmat
 from numpy.fft import fft
+from thunder.util.permutation import permutations, permtest
 
 
 class SigProcessingMethod(object):
@@ -122,6 +124,41 @@ class CrossCorrMethod(SigProcessingMethod):
             b = dot(self.x, y)
         return b
 
+    def permtest(self, data, nperm=1000, seed=0, null=False, chunksize=1000):
+        """Test the cross correlations of every record against a null
+        distribution from correlations with time points randomly permuted
+
+        The signal (at every lag) and all its permutations are stacked into
+        a single operator, so every correlation for a block of records
+        comes from one product (the operator is broadcast). The test is two sided
+        (on absolute correlations)
+
+        :param data: RDD of data points as key value pairs
+        :param nperm: number of permutations (default = 1000)
+        :param seed: seed for the random permutations (default = 0, for no seed)
+        :param null: whether to also return the null distributions (default = False)
+        :param chunksize: number of records tested at once (default = 1000)
+
+        :return pvals: RDD with the p-values of the correlations of each record (one per lag)
+        :return nulls: RDD with the correlations of each record for every permutation (only if null is True)
+        """
+        x = atleast_2d(self.x)
+        m, d = shape(x)
+        perms = permutations(d, nperm, seed)
+        stacked = transpose(concatenate([x] + [x[:, perm] for perm in perms]))
+        squeeze = len(shape(self.x)) == 1
+
+        def stats(y, stacked):
+            y = y - mean(y, axis=1)[:, newaxis]
+            n = sqrt(sum(y ** 2, axis=1))
+            y = y / where(n == 0, 1, n)[:, newaxis]
+            b = dot(y, stacked).reshape(len(y), nperm + 1, m)
+            if squeeze:
+                b = b[:, :, 0]
+            return abs(b[:, 0]), abs(b[:, 1:])
+
+        return permtest(data, stats, stacked, null, chunksize)
+
 
 SIGPROCESSING_METHODS = {
     'stats': StatsMethod,
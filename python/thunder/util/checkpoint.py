@@ -0,0 +1,74 @@
+"""
+Utilities for checkpointing iterative algorithms
+"""
+
+import os
+import cPickle
+
+
+class Checkpoint(object):
+    """Class for periodically saving the driver state of an iterative
+    algorithm (e.g. centers, iteration count, error history)
+    and for restoring it to resume after a failure
+
+    Only the most recent state is kept for each algorithm. RDDs used
+    across iterations can also be checkpointed through Spark, so that
+    their lineage is truncated and they are recovered from disk
+    """
+
+    def __init__(self, path, interval=10, resume=False):
+        """Create checkpoint
+
+        :param path: Directory to save states (and checkpointed RDDs) to
+        :param interval: Number of iterations between saved states (default = 10)
+        :param resume: Whether to restore the most recent saved state (default = False)
+        """
+        self.path = path
+        self.interval = interval
+        self.resume = resume
+
+    def filename(self, name):
+        return os.path.join(self.path, name + ".pickle")
+
+    def restore(self, name):
+        """Get the most recent saved state of an algorithm, if resuming
+
+        :param name: Name of the algorithm
+        :return state: Dictionary with the saved state (None if not resuming or nothing saved)
+        """
+        filename = self.filename(name)
+        if self.resume & os.path.exists(filename):
+            with open(filename, "rb") as f:
+                return cPickle.load(f)
+        else:
+            return None
+
+    def save(self, name, iter, state):
+        """Save the state of an algorithm, if at the end of an interval
+
+        The state is written to a temporary file that then replaces
+        the previous state, so a failure while saving doesn't lose it
+
+        :param name: Name of the algorithm
+        :param iter: Current iteration
+        :param state: Dictionary with the state to save
+        """
+        if iter % self.interval == 0:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            filename = self.filename(name)
+            with open(filename + ".tmp", "wb") as f:
+                cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(filename + ".tmp", filename)
+
+    def truncate(self, rdd):
+        """Checkpoint an RDD through Spark to truncate its lineage,
+        should be called before the RDD is first used
+        (and the RDD should be persisted, otherwise it is computed twice)
+
+        :param rdd: RDD to checkpoint
+        :return rdd: The same RDD
+        """
+        rdd.context.setCheckpointDir(os.path.join(self.path, "rdd"))
+        rdd.checkpoint()
+        return rdd
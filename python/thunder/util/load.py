@@ -2,10 +2,14 @@
 Utilities for loading and preprocessing data
 """
 
+import os
+import glob
+import time
 import pyspark
 
 from numpy import array, mean, cumprod, append, mod, ceil, size, polyfit, polyval, arange, percentile, inf, subtract
 from scipy.signal import butter, lfilter
+from scipy.io import loadmat
 
 
 class Dimensions(object):
@@ -212,3 +216,46 @@ def load(sc, datafile, preprocessmethod="raw", nkeys=3):
     return data
 
 
+def loadresult(result, name):
+    """Load an array from the output of a previous analysis
+    (e.g. to use as a starting point for an iterative algorithm)
+
+    :param result: An array, or a string with the location of a MAT file saved by save,
+    or of the output directory containing it as name.mat
+    :param name: Name of the saved variable (e.g. "centers")
+    :return result: Array with the saved values
+    """
+    if type(result) is str:
+        if os.path.isdir(result):
+            result = os.path.join(result, name + ".mat")
+        return loadmat(result)[name]
+    else:
+        return result
+
+
+def loadbatches(sc, directory, preprocessmethod="raw", nkeys=3, interval=1.0, timeout=None):
+    """Load batches of data from files as they are written to a directory
+    (same format as load). All files that appeared since the previous batch
+    are loaded together as the next batch, in order of modification time
+
+    :param sc: SparkContext
+    :param directory: Location to watch for new data files
+    :param preprocessmethod: Type of preprocessing to perform ("raw", "dff", "sub")
+    :param nkeys: Number of keys per data point
+    :param interval: Seconds to wait between checks for new files (default = 1.0)
+    :param timeout: Seconds without new files before stopping (default = None, for never stop)
+    :return batches: generator of RDDs of data points as key value pairs
+    """
+    seen = set()
+    waited = 0
+
+    while (timeout is None) or (waited <= timeout):
+        files = filter(lambda f: (f not in seen) & os.path.isfile(f), glob.glob(os.path.join(directory, "*")))
+        if len(files) > 0:
+            files = sorted(files, key=os.path.getmtime)
+            seen.update(files)
+            waited = 0
+            yield load(sc, ",".join(files), preprocessmethod, nkeys)
+        else:
+            time.sleep(interval)
+            waited += interval
@@ -8,7 +8,7 @@ TODO: test using these in the various analyses packages (especially thunder.fact
 """
 
 import sys
-from numpy import dot, allclose, outer, shape, ndarray, mean, add, subtract, multiply, zeros, std, divide
+from numpy import array, dot, allclose, outer, shape, ndarray, mean, add, subtract, multiply, zeros, std, divide
 from pyspark.accumulators import AccumulatorParam
 
 
@@ -20,6 +20,20 @@ def matrixsum_iterator_other(iterator):
     yield sum(outer(x, y) for x, y in iterator)
 
 
+def matrixstack_iterator(iterator):
+    """Stack the key value pairs of a partition into
+    a list of keys and a 2d array with one row per record
+    (empty partitions produce nothing)
+    """
+    keys = []
+    rows = []
+    for k, v in iterator:
+        keys.append(k)
+        rows.append(v)
+    if len(rows) > 0:
+        yield keys, array(rows)
+
+
 class MatrixAccumulatorParam(AccumulatorParam):
     def zero(self, value):
         return zeros(shape(value))
@@ -0,0 +1,70 @@
+"""
+Utilities for permutation tests
+"""
+
+from numpy import sum, newaxis, random, array
+from thunder.util.matrixrdd import matrixstack_iterator
+
+
+def permutations(n, nperm, seed=0):
+    """Generate random permutations
+
+    :param n: number of elements to permute
+    :param nperm: number of permutations
+    :param seed: seed for the random permutations (default = 0, for no seed)
+
+    :return perms: array of permutations (one per row)
+    """
+    rng = random.RandomState(seed) if seed != 0 else random.RandomState()
+    return array([rng.permutation(n) for i in range(0, nperm)])
+
+
+def pvalues(stats, nulls):
+    """Compute p-values of statistics against their null distributions,
+    as the fraction of null statistics at least as large (counting the statistic itself)
+
+    :param stats: array of statistics (one row per record)
+    :param nulls: array of null statistics (records x permutations x statistics)
+
+    :return pvals: array of p-values (same shape as stats)
+    """
+    return (1.0 + sum(nulls >= stats[:, newaxis], axis=1)) / (1.0 + nulls.shape[1])
+
+
+def permtest(data, statfunc, operator, null=False, chunksize=1000):
+    """Do a permutation test on every record, a block of records at a time
+
+    The operator (typically stacking the original and permuted designs) is broadcast
+    once rather than shipped with every task. Each block is tested a chunk of records
+    at a time, so the statistics for all permutations are only ever held for one chunk.
+    With null distributions, the statistics and null statistics are computed once into
+    a persisted RDD that pvals and nulls are both projected from
+
+    :param data: RDD of data points as key value pairs
+    :param statfunc: function of a block of records (one per row) and the operator returning the
+        statistics (one row per record) and the null statistics (records x permutations x statistics)
+    :param operator: array used by statfunc for every block
+    :param null: whether to also return the null statistics (default = False)
+    :param chunksize: number of records tested at once (default = 1000)
+
+    :return pvals: RDD with p-values for each record
+    :return nulls: RDD with null statistics for each record (only if null is True)
+    """
+    ob = data.context.broadcast(operator)
+    blocks = data.mapPartitions(matrixstack_iterator)
+
+    def test(y):
+        result = []
+        for i in range(0, len(y), chunksize):
+            stats, nulls = statfunc(y[i:i + chunksize], ob.value)
+            if null:
+                result.extend(zip(pvalues(stats, nulls), nulls))
+            else:
+                result.extend(pvalues(stats, nulls))
+        return result
+
+    if null:
+        result = blocks.flatMap(lambda (keys, y): zip(keys, test(y))).cache()
+        return result.mapValues(lambda x: x[0]), result.mapValues(lambda x: x[1])
+    else:
+        return blocks.flatMap(lambda (keys, y): zip(keys, test(y)))